@@ -0,0 +1,82 @@
+import sys
+import json
+import time
+import argparse
+import platform
+from benchmarks import suite, vault
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def medians(results: dict, prefix: str = '') -> dict:
+    found = {}
+    for name, value in results.items():
+        if isinstance(value, dict) and 'median' in value:
+            found[prefix + name] = value['median']
+        elif isinstance(value, dict):
+            found.update(medians(value, prefix + name + '.'))
+    return found
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    old = medians(baseline['results'])
+    regressions = []
+    for name, value in sorted(medians(current['results']).items()):
+        if name in old and old[name]:
+            ratio = value / old[name]
+            flag = ' REGRESSION' if ratio > 1 + threshold else ''
+            print(f'{name:<60} {ratio:6.2f}x{flag}')
+            if flag:
+                regressions.append(name)
+    return regressions
+
+
+def main(args: list) -> int:
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='vault sizes to generate and measure '
+                             '(e.g. 1000 10000 100000 1000000)')
+    parser.add_argument('--workdir', default='.bench',
+                        help='where generated vaults are kept')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--check', action='store_true',
+                        help='exit non-zero on regressions or a blown '
+                             'startup budget')
+    options = parser.parse_args(args)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': options.repeat,
+        },
+        'results': {},
+    }
+    for size in options.sizes:
+        print(f'Preparing vault with {size} entries...', flush=True)
+        directory = vault.build_vault(options.workdir, size)
+        print(f'Measuring {size}...', flush=True)
+        report['results'][str(size)] = suite.run_suite(directory, size,
+                                                       options.repeat)
+
+    with open(options.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Results written to ' + options.output)
+
+    failed = [size for size, results in report['results'].items()
+              if not results['startup']['within_budget']]
+    for size in failed:
+        print(f'Startup budget exceeded for {size} entries')
+    if options.compare:
+        with open(options.compare) as file:
+            failed += compare(report, json.load(file), options.threshold)
+    return 1 if options.check and failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
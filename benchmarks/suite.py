@@ -0,0 +1,388 @@
+import io
+import os
+import sys
+import time
+import random
+import shutil
+import statistics
+import tracemalloc
+import tempfile
+import contextlib
+import subprocess
+import agent
+import storage
+import database as db
+import logstore
+import encryption as enc
+import dynamic_search as ds
+import data_manipulation as dm
+import search
+import passwords
+import kdf
+import sync
+from typing import Callable, Dict, Iterator, List, Tuple
+from constants import DATABASE_FILE
+from benchmarks import CORE
+from benchmarks.vault import MASTER_PASSWORD, generate_entries
+
+SYNC_CHANGES = 5
+# Lookups took a median of 0.54-0.65s for a missing entry and 0.62-0.67s
+# for one decrypted with a key from the agent, most of it importing
+# SQLAlchemy. The budgets leave a little over a tenth on top of that.
+STARTUP_BUDGETS = {'miss': 0.75, 'hit': 0.85}
+STARTUP_FORBIDDEN = {
+    'miss': ('cryptography', 'bcrypt', 'pyperclip', 'menu',
+             'data_manipulation', 'kdf'),
+    'hit': ('bcrypt', 'pyperclip', 'menu', 'data_manipulation', 'kdf'),
+}
+STARTUP_MISSING = ['get', 'startup.probe']
+STARTUP_PROBE = ('import sys, cli; cli.main({!r}); '
+                 'print(",".join(m for m in {!r} if m in sys.modules))')
+
+
+def summarise(samples: List[float], operations: int = 1) -> dict:
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'mean': statistics.mean(samples),
+        'ops_per_sec': operations / statistics.median(samples)
+        if statistics.median(samples) else None,
+    }
+
+
+def measure(func: Callable[[], object], repeat: int,
+            operations: int = 1) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarise(samples, operations)
+
+
+def peak_memory(func: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def keystroke_queries(database: db.Database, count: int) -> List[str]:
+    rng = random.Random(1)
+    sites = [x.site for x in database.query_entries()]
+    return [rng.choice(sites).split('.')[0][:8] for _ in range(count)]
+
+
+def bench_search(database: db.Database, repeat: int) -> dict:
+    accounts = database.query_entries()
+    targets = [x.site for x in accounts] + [x.username for x in accounts]
+    queries = keystroke_queries(database, repeat)
+    keystrokes, sessions, matches = [], [], []
+    for query in queries:
+        session = ds.SearchSession(database)
+        for i in range(1, len(query) + 1):
+            start = time.perf_counter()
+            ds.fuzzy_search(query[:i], database)
+            keystrokes.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            session.append(query[i - 1])
+            sessions.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for target in targets:
+            search.is_found(query, target)
+        matches.append(time.perf_counter() - start)
+    return {
+        'fuzzy_search_per_keystroke': summarise(keystrokes),
+        'session_per_keystroke': summarise(sessions),
+        'is_found_full_scan': summarise(matches, len(targets)),
+    }
+
+
+def bench_listing(database: db.Database, key: bytes, repeat: int) -> dict:
+    def iterate() -> None:
+        for _ in database.query_all_entries():
+            pass
+
+    def show() -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            dm.show_all(database, key)
+
+    rows = database.count()
+    return {
+        'query_all_entries': measure(iterate, repeat, rows),
+        'show_all': measure(show, max(1, repeat // 2), rows),
+        'count': measure(database.count, repeat),
+        'is_empty': measure(database.is_empty, repeat),
+        'peak_bytes': {
+            'query_database': peak_memory(database.query_database),
+            'query_entries': peak_memory(database.query_entries),
+        },
+    }
+
+
+def bench_crypto(database: db.Database, key: bytes, repeat: int) -> dict:
+    rows = [(x.site, x.username, x.password)
+            for x in database.query_database()[:5000]]
+    plain = [(site, username, password) for (site, username, _), password
+             in zip(rows, enc.decrypt_passwords(rows, key))]
+    fernet = enc.get_cipher(key).fernet
+    legacy = [(site, username, fernet.encrypt(password.encode()).decode())
+              for site, username, password in plain]
+    return {
+        'encrypt_password': measure(
+            lambda: [enc.encrypt_password(x, key, site, username)
+                     for site, username, x in plain],
+            repeat, len(plain)),
+        'decrypt_password': measure(
+            lambda: [enc.decrypt_password(x, key, site, username)
+                     for site, username, x in rows],
+            repeat, len(rows)),
+        'decrypt_passwords': measure(
+            lambda: enc.decrypt_passwords(rows, key), repeat, len(rows)),
+        'decrypt_passwords_legacy': measure(
+            lambda: enc.decrypt_passwords(legacy, key), repeat, len(legacy)),
+        'record_bytes': sum(len(x[2]) for x in rows) / max(1, len(rows)),
+        'legacy_record_bytes': sum(len(x[2]) for x in legacy) /
+        max(1, len(legacy)),
+    }
+
+
+def bench_passwords(repeat: int) -> dict:
+    count = 10000
+    policy = passwords.Policy(20, symbols=True,
+                              minimums={'lower': 1, 'upper': 1,
+                                        'digits': 1, 'symbols': 1})
+    return {
+        'generate_password': measure(
+            lambda: [passwords.generate_password(16) for _ in range(count)],
+            repeat, count),
+        'generate_many': measure(
+            lambda: passwords.generate_many(count, passwords.Policy(16)),
+            repeat, count),
+        'generate_many_minimums': measure(
+            lambda: passwords.generate_many(count, policy), repeat, count),
+        'generate_many_passphrase': measure(
+            lambda: passwords.generate_many(count, passwords.Policy(words=5)),
+            repeat, count),
+    }
+
+
+def bench_insert(directory: str, key: bytes, size: int) -> dict:
+    scratch = directory + '-scratch'
+    shutil.rmtree(scratch, ignore_errors=True)
+    shutil.copytree(directory, scratch)
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        database = db.Database()
+        database.migrate()
+        entries = list(generate_entries(2200, seed=size + 1))
+        entries = [(site + '.bench', username,
+                    enc.encrypt_password(pw, key, site + '.bench', username))
+                   for site, username, pw in entries]
+        single, bulk = entries[:200], entries[200:]
+        start = time.perf_counter()
+        for site, username, password in single:
+            database.insert_data(site, username, password)
+        single_time = time.perf_counter() - start
+        start = time.perf_counter()
+        database.insert_many(bulk)
+        bulk_time = time.perf_counter() - start
+        database.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {
+        'insert_data': summarise([single_time], len(single)),
+        'insert_many': summarise([bulk_time], len(bulk)),
+    }
+
+
+def bench_sync(directory: str, key: bytes, repeat: int) -> dict:
+    copies = [directory + '-sync-local', directory + '-sync-remote']
+    for copy in copies:
+        shutil.rmtree(copy, ignore_errors=True)
+        shutil.copytree(directory, copy)
+    local, remote = [db.Database(os.path.join(copy, DATABASE_FILE))
+                     for copy in copies]
+    try:
+        local.migrate()
+        remote.migrate()
+        entries = local.query_entries()
+        rng = random.Random(3)
+        results = {'in_sync': measure(
+            lambda: sync.merge(local, remote, key, key), repeat)}
+        samples = []
+        for _ in range(repeat):
+            for entry in rng.sample(entries, SYNC_CHANGES):
+                local.update_item(entry.site, entry.username,
+                                  enc.encrypt_password('changed', key,
+                                                       entry.site,
+                                                       entry.username))
+            start = time.perf_counter()
+            sync.merge(local, remote, key, key)
+            samples.append(time.perf_counter() - start)
+        results['few_changes'] = summarise(samples, SYNC_CHANGES)
+    finally:
+        local.close()
+        remote.close()
+        for copy in copies:
+            shutil.rmtree(copy, ignore_errors=True)
+    return results
+
+
+def build_log_vault(directory: str) -> str:
+    target = directory + '-log'
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        source = db.Database()
+        password = source.retrieve_password()
+        rows = [(x.site, x.username, x.password)
+                for x in source.query_database()]
+        source.close()
+        os.chdir(target)
+        vault = logstore.LogDatabase()
+        vault.create_database()
+        vault.set_password(password)
+        vault.insert_many(rows)
+        vault.rebuild_index()
+        vault.close()
+    finally:
+        os.chdir(cwd)
+    return target
+
+
+def bench_storage(directory: str, key: bytes, repeat: int) -> dict:
+    log_directory = build_log_vault(directory)
+    rng = random.Random(2)
+    results = {}
+    for name, backend, path in (('sqlite', db.Database, directory),
+                                ('log', logstore.LogDatabase,
+                                 log_directory)):
+        def lookup() -> None:
+            database = backend()
+            database.query_site_and_user(rng.choice(sites), 'probe')
+            database.close()
+
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            probe = backend()
+            entries = probe.query_entries()[:1000]
+            sites = [x.site for x in entries]
+            entry = entries[0]
+            probe.close()
+            startup = bench_startup(path, key, (entry.site, entry.username),
+                                    repeat)
+            results[name] = {
+                'open_and_lookup': measure(lookup, max(repeat, 20)),
+                'cli_lookup': startup['cli_lookup'],
+                'cli_hit': startup['cli_hit'],
+            }
+        finally:
+            os.chdir(cwd)
+    shutil.rmtree(log_directory, ignore_errors=True)
+    return results
+
+
+@contextlib.contextmanager
+def startup_agent(directory: str, key: bytes) -> Iterator[Dict[str, str]]:
+    # The probes get the key from an agent of their own, as after
+    # "pypass agent unlock", so a hit is timed without a password prompt.
+    runtime = tempfile.mkdtemp()
+    saved = os.environ.get('XDG_RUNTIME_DIR')
+    os.environ['XDG_RUNTIME_DIR'] = runtime
+    try:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            vault = agent.vault_path()
+        finally:
+            os.chdir(cwd)
+        agent.start(vault, key, 600)
+        try:
+            yield dict(os.environ, PYTHONPATH=CORE)
+        finally:
+            agent.request({'cmd': 'lock'})
+    finally:
+        if saved is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = saved
+        shutil.rmtree(runtime, ignore_errors=True)
+
+
+def probe_startup(directory: str, env: Dict[str, str], args: List[str],
+                  forbidden: tuple) -> tuple:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c',
+                             STARTUP_PROBE.format(args, forbidden)],
+                            cwd=directory, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    lines = result.stdout.decode().splitlines()
+    loaded = lines[-1].split(',') if lines and lines[-1] else []
+    return elapsed, lines[:-1], result.stderr.decode(), loaded
+
+
+def bench_startup(directory: str, key: bytes, entry: Tuple[str, str],
+                  repeat: int) -> dict:
+    results = {
+        'interpreter': measure(
+            lambda: subprocess.run([sys.executable, '-c', 'pass']), repeat),
+        'budgets': STARTUP_BUDGETS,
+        'heavy_modules_loaded': {},
+        'within_budget': True,
+    }
+    with startup_agent(directory, key) as env:
+        for name, kind, args in (('lookup', 'miss', STARTUP_MISSING),
+                                 ('hit', 'hit', ['get', *entry])):
+            samples, output, loaded = [], [], []
+            for _ in range(repeat):
+                elapsed, output, _, loaded = probe_startup(
+                    directory, env, args, STARTUP_FORBIDDEN[kind])
+                samples.append(elapsed)
+            stats = summarise(samples)
+            results['cli_' + name] = stats
+            results['heavy_modules_loaded'][kind] = loaded
+            # A hit that printed nothing timed an error, not a lookup.
+            if stats['median'] > STARTUP_BUDGETS[kind] or loaded or \
+                    (kind == 'hit') != bool(output):
+                results['within_budget'] = False
+    return results
+
+
+def run_suite(directory: str, size: int, repeat: int) -> dict:
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        database = db.Database()
+        database.migrate()
+        key = kdf.unlock(MASTER_PASSWORD, database.retrieve_password())
+        results = {
+            'search': bench_search(database, repeat),
+            'listing': bench_listing(database, key, repeat),
+            'crypto': bench_crypto(database, key, repeat),
+        }
+        probe = database.query_entries()[0]
+        stored = database.retrieve_password()
+        results['crypto']['unlock'] = measure(
+            lambda: kdf.unlock(MASTER_PASSWORD, stored), max(1, repeat // 2))
+        database.close()
+    finally:
+        os.chdir(cwd)
+    results['insert'] = bench_insert(directory, key, size)
+    results['sync'] = bench_sync(directory, key, repeat)
+    results['passwords'] = bench_passwords(repeat)
+    results['startup'] = bench_startup(directory, key,
+                                       (probe.site, probe.username), repeat)
+    results['storage'] = bench_storage(directory, key, repeat)
+    return results
@@ -0,0 +1,95 @@
+import os
+import random
+import string
+import itertools
+import kdf
+import database as db
+import encryption as enc
+from typing import Iterator, Tuple
+from constants import DATABASE_FILE
+
+Entry = Tuple[str, str, str]
+
+MASTER_PASSWORD = 'benchmark'
+PASSWORD_ALPHABET = string.ascii_letters + string.digits
+
+WORDS = ['mail', 'bank', 'shop', 'cloud', 'news', 'photo', 'music', 'game',
+         'travel', 'health', 'code', 'book', 'video', 'social', 'chat',
+         'home', 'market', 'pay', 'learn', 'sport', 'food', 'car', 'job',
+         'tech', 'art', 'dev', 'data', 'store', 'hub', 'box', 'net', 'app']
+TLDS = ['com'] * 12 + ['org'] * 3 + ['net'] * 3 + ['io'] * 2 + \
+    ['co.uk', 'de', 'ca', 'fr', 'dev', 'app']
+PREFIXES = [''] * 6 + ['www.', 'accounts.', 'login.', 'my.', 'app.']
+NAMES = ['felix', 'alex', 'sam', 'jordan', 'taylor', 'morgan', 'casey',
+         'riley', 'jamie', 'drew', 'quinn', 'avery', 'kai', 'rowan', 'sky']
+MAIL_DOMAINS = ['gmail.com'] * 6 + ['outlook.com'] * 2 + \
+    ['yahoo.com', 'proton.me', 'icloud.com', 'work.example']
+
+
+def vault_dir(workdir: str, size: int) -> str:
+    return os.path.join(workdir, 'vault-' + str(size))
+
+
+def make_site(rng: random.Random) -> str:
+    name = ''.join(rng.sample(WORDS, rng.choice((1, 1, 2, 2, 3))))
+    if rng.random() < 0.3:
+        name += str(rng.randint(1, 999))
+    return rng.choice(PREFIXES) + name + '.' + rng.choice(TLDS)
+
+
+def make_username(rng: random.Random, owners: list) -> str:
+    if rng.random() < 0.7:
+        return rng.choice(owners)
+    name = rng.choice(NAMES) + rng.choice(['', '.', '_']) + \
+        rng.choice(NAMES) + str(rng.randint(0, 9999))
+    if rng.random() < 0.5:
+        return name + '@' + rng.choice(MAIL_DOMAINS)
+    return name
+
+
+def generate_entries(size: int, seed: int = 0) -> Iterator[Entry]:
+    # Sites are drawn from a Zipf-like distribution so a few popular
+    # sites hold many accounts, and most accounts reuse a handful of
+    # owner identities, as in a real vault.
+    rng = random.Random(seed)
+    sites = [make_site(rng) for _ in range(max(1, size // 3))]
+    weights = [1 / (rank + 1) for rank in range(len(sites))]
+    owners = [rng.choice(NAMES) + '@' + rng.choice(MAIL_DOMAINS)
+              for _ in range(5)]
+    seen = set()
+    while len(seen) < size:
+        for site in rng.choices(sites, weights, k=size - len(seen)):
+            pair = (site, make_username(rng, owners))
+            if pair not in seen:
+                seen.add(pair)
+                password = ''.join(rng.choice(PASSWORD_ALPHABET)
+                                   for _ in range(rng.randint(10, 24)))
+                yield pair[0], pair[1], password
+
+
+def build_vault(workdir: str, size: int, seed: int = 0) -> str:
+    directory = vault_dir(workdir, size)
+    path = os.path.join(directory, DATABASE_FILE)
+    if os.path.exists(path):
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        database = db.Database()
+        database.create_database()
+        header, key = kdf.create(MASTER_PASSWORD)
+        database.set_password(header)
+        entries = generate_entries(size, seed)
+        while True:
+            chunk = list(itertools.islice(entries, 5000))
+            if not chunk:
+                break
+            encrypted = enc.encrypt_passwords(chunk, key)
+            database.insert_many([(site, username, password)
+                                  for (site, username, _), password
+                                  in zip(chunk, encrypted)])
+        database.close()
+    finally:
+        os.chdir(cwd)
+    return directory
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import stat
+import select
+import socket
+import struct
+import argparse
+import tempfile
+from typing import Optional
+from constants import AGENT_TIMEOUT
+
+
+class AgentError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+def socket_path() -> str:
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    directory = os.path.join(base, 'pypass-' + str(os.getuid()))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            info.st_mode & 0o077:
+        raise AgentError("[Error]: Unsafe agent directory " + directory)
+    return os.path.join(directory, 'agent.sock')
+
+
+def vault_path() -> str:
+    import storage
+    return os.path.abspath(storage.vault_file())
+
+
+def send_message(connection: socket.socket, message: dict) -> None:
+    connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+def read_message(connection: socket.socket) -> dict:
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode() or '{}')
+
+
+def request(message: dict) -> Optional[dict]:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(1.0)
+            connection.connect(socket_path())
+            send_message(connection, message)
+            return read_message(connection)
+    except (OSError, ValueError, AgentError):
+        return None
+
+
+def fetch_key(vault: str) -> Optional[bytes]:
+    response = request({'cmd': 'get', 'vault': vault})
+    if response and response.get('key'):
+        return response['key'].encode()
+    return None
+
+
+def peer_allowed(connection: socket.socket) -> bool:
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    credentials = connection.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1] == os.getuid()
+
+
+def handle(connection: socket.socket, keys: dict, timeout: float) -> bool:
+    message = read_message(connection)
+    command = message.get('cmd')
+    if command == 'get':
+        key = keys.get(message.get('vault'))
+        send_message(connection, {'key': key})
+        return key is not None
+    if command == 'put':
+        keys[message['vault']] = message['key']
+        send_message(connection, {'ok': True})
+        return True
+    if command == 'lock':
+        keys.clear()
+        send_message(connection, {'ok': True})
+        return False
+    if command == 'status':
+        send_message(connection, {'vaults': sorted(keys),
+                                  'timeout': timeout})
+        return False
+    send_message(connection, {'error': 'unknown command'})
+    return False
+
+
+def serve(listener: socket.socket, keys: dict, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while keys:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not select.select([listener], [], [], remaining)[0]:
+            continue
+        connection, _ = listener.accept()
+        with connection:
+            connection.settimeout(1.0)
+            try:
+                if peer_allowed(connection) and \
+                        handle(connection, keys, timeout):
+                    deadline = time.monotonic() + timeout
+            except (OSError, ValueError, KeyError):
+                continue
+    keys.clear()
+
+
+def start(vault: str, key: bytes, timeout: float) -> None:
+    if request({'cmd': 'put', 'vault': vault, 'key': key.decode()}):
+        return None
+    path = socket_path()
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(8)
+
+    if os.fork():
+        listener.close()
+        return None
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    except (ImportError, ValueError, OSError):
+        pass
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for stream in (0, 1, 2):
+        os.dup2(devnull, stream)
+    try:
+        serve(listener, {vault: key.decode()}, timeout)
+    finally:
+        listener.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        os._exit(0)
+
+
+def unlock(timeout: float) -> None:
+    import storage
+    import data_manipulation as dm
+    database = storage.open_backend()
+    if not os.path.exists(database.path):
+        raise AgentError("[Error]: No password repository found")
+    start(vault_path(), dm.handle_password(True, database), timeout)
+    print("Agent unlocked for " + format(timeout, '.0f') + "s of idle time")
+
+
+def main(args: list) -> None:
+    parser = argparse.ArgumentParser(prog='pypass agent')
+    parser.add_argument('command', choices=['unlock', 'lock', 'status'])
+    parser.add_argument('--timeout', type=float, default=AGENT_TIMEOUT,
+                        help='seconds of inactivity before the key is '
+                             'forgotten')
+    options = parser.parse_args(args)
+    if options.command == 'unlock':
+        try:
+            unlock(options.timeout)
+        except AgentError as error:
+            print(error)
+    elif options.command == 'lock':
+        print("Agent locked" if request({'cmd': 'lock'})
+              else "Agent is not running")
+    else:
+        response = request({'cmd': 'status'})
+        if not response:
+            print("Agent is not running")
+        else:
+            print("Agent holds keys for: " +
+                  (', '.join(response['vaults']) or 'nothing'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
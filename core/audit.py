@@ -0,0 +1,197 @@
+import os
+import hmac
+import math
+import mmap
+import time
+import hashlib
+import profiler
+import storage
+import encryption as enc
+from typing import Callable, Dict, List, Optional, Tuple
+from constants import UPPER, LOWER, DIGITS, AUDIT_CHUNK_SIZE, \
+    AUDIT_MIN_ENTROPY, LEGACY_BITS_PER_CHAR, BREACH_LIST_FILE, \
+    BREACH_LIST_VARIABLE
+
+DIGEST_LENGTH = 40
+LEGACY_ALPHABET = frozenset(UPPER + LOWER + DIGITS)
+CHARACTER_CLASSES = (frozenset(LOWER), frozenset(UPPER), frozenset(DIGITS))
+PRINTABLE_SYMBOLS = 33
+
+
+class AuditError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class BreachList:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            self.file = open(path, 'rb')
+        except OSError as error:
+            raise AuditError("Cannot open breach list: " + str(error))
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise AuditError(path + " is empty")
+        first = self.map[:DIGEST_LENGTH + 1]
+        if len(first) <= DIGEST_LENGTH or first[-1:] not in b':\r\n' or \
+                not first[:DIGEST_LENGTH].isalnum():
+            self.close()
+            raise AuditError(path + " is not a SHA-1 breach list "
+                             "ordered by hash")
+
+    def __enter__(self) -> 'BreachList':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+    def count(self, digest: bytes) -> int:
+        # The file is searched by byte offset: every probe backs up to the
+        # start of the line it landed in. Hashes are uniformly spread, so
+        # every other probe is placed by interpolation between the bounds,
+        # and the plain halving in between keeps the worst case at log n.
+        low, high = 0, len(self.map)
+        low_key, high_key = 0, 1 << 32
+        target = int(digest[:8], 16)
+        guessing = True
+        while low < high:
+            if guessing and high_key > low_key:
+                middle = low + (high - low) * (target - low_key) // \
+                    (high_key - low_key)
+                middle = min(max(middle, low), high - 1)
+            else:
+                middle = (low + high) // 2
+            guessing = not guessing
+            start = self.map.rfind(b'\n', low, middle) + 1 or low
+            end = self.map.find(b'\n', start)
+            if end < 0:
+                end = len(self.map)
+            key = self.map[start:start + DIGEST_LENGTH].upper()
+            if key == digest:
+                return int(self.map[start + DIGEST_LENGTH + 1:end].strip()
+                           or 1)
+            if key < digest:
+                low, low_key = end + 1, int(key[:8], 16)
+            else:
+                high, high_key = start, int(key[:8], 16)
+        return 0
+
+
+class AuditReport:
+
+    def __init__(self) -> None:
+        self.entries = 0
+        self.weak = []
+        self.breached = []
+        self.reused = []
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+
+def breach_list_path() -> Optional[str]:
+    path = os.environ.get(BREACH_LIST_VARIABLE) or BREACH_LIST_FILE
+    return path if os.path.exists(path) else None
+
+
+def estimate_entropy(password: str) -> float:
+    if not password:
+        return 0.0
+    if LEGACY_ALPHABET.issuperset(password):
+        # Letters and digits only is what the old generator produced. It
+        # picked the class of every character with the non-cryptographic
+        # random module, so only the character within the class counts.
+        return len(password) * min(
+            LEGACY_BITS_PER_CHAR,
+            math.log2(sum(len(chars) for chars in CHARACTER_CLASSES
+                          if not chars.isdisjoint(password))))
+    size = sum(len(chars) for chars in CHARACTER_CLASSES
+               if not chars.isdisjoint(password))
+    if any(x not in LEGACY_ALPHABET for x in password):
+        size += PRINTABLE_SYMBOLS
+    return len(password) * math.log2(size)
+
+
+def audit_vault(database: storage.Backend, key: bytes,
+                breaches: Optional[BreachList] = None,
+                progress: Optional[Callable[[int], None]] = None
+                ) -> AuditReport:
+    # Identical passwords are grouped by an HMAC under a key that only
+    # lives for this audit, so no digest outlives the report.
+    report = AuditReport()
+    secret = os.urandom(32)
+    groups = {}
+    seen = {}
+    batch = []
+    for _, accounts in database.query_all_entries():
+        batch += accounts
+        if len(batch) >= AUDIT_CHUNK_SIZE:
+            audit_batch(batch, key, secret, breaches, groups, seen, report)
+            batch = []
+            if progress is not None:
+                progress(report.entries)
+    audit_batch(batch, key, secret, breaches, groups, seen, report)
+    report.reused = sorted((entries for entries in groups.values()
+                            if len(entries) > 1),
+                           key=lambda x: (-len(x), x[0].site))
+    report.elapsed = time.perf_counter() - report.start
+    return report
+
+
+def audit_batch(batch: list, key: bytes, secret: bytes,
+                breaches: Optional[BreachList],
+                groups: Dict[bytes, List[storage.Entry]],
+                seen: Dict[bytes, Tuple[float, int]],
+                report: AuditReport) -> None:
+    if not batch:
+        return None
+    passwords = enc.decrypt_passwords(
+        ((x.site, x.username, x.password) for x in batch), key)
+    with profiler.span('audit.batch'):
+        for account, password in zip(batch, passwords):
+            entry = storage.Entry(account.id, account.site, account.username)
+            encoded = password.encode()
+            digest = hmac.digest(secret, encoded, 'sha256')
+            groups.setdefault(digest, []).append(entry)
+            if digest not in seen:
+                found = breaches.count(hashlib.sha1(encoded).hexdigest().
+                                       upper().encode()) \
+                    if breaches is not None else 0
+                seen[digest] = (estimate_entropy(password), found)
+            bits, found = seen[digest]
+            if bits < AUDIT_MIN_ENTROPY:
+                report.weak.append((entry, bits))
+            if found:
+                report.breached.append((entry, found))
+    report.entries += len(batch)
+
+
+def report_lines(report: AuditReport, checked_breaches: bool) -> List[str]:
+    lines = ['Audited ' + str(report.entries) + ' entries in ' +
+             '%.2f' % report.elapsed + 's', '']
+    if checked_breaches:
+        lines.append('Breached passwords: ' + str(len(report.breached)))
+        lines += ['    ' + entry.site + '  ' + entry.username +
+                  '  (seen ' + str(found) + ' times)'
+                  for entry, found in report.breached]
+    else:
+        lines.append('Breached passwords: not checked, no breach list found')
+    lines.append('Reused passwords: ' +
+                 str(sum(len(x) for x in report.reused)))
+    for entries in report.reused:
+        lines.append('    shared by ' + str(len(entries)) + ' entries')
+        lines += ['        ' + entry.site + '  ' + entry.username
+                  for entry in entries]
+    lines.append('Weak passwords: ' + str(len(report.weak)))
+    lines += ['    ' + entry.site + '  ' + entry.username +
+              '  (about ' + str(int(bits)) + ' bits)'
+              for entry, bits in report.weak]
+    return lines
@@ -0,0 +1,419 @@
+from __future__ import annotations
+import os
+import sys
+import argparse
+from typing import Optional, TYPE_CHECKING
+from constants import DEFAULT_PASSWORD_LENGTH, KDF_TARGET_SECONDS, \
+    DATABASE_FILE
+
+if TYPE_CHECKING:
+    import storage
+    import passwords
+
+
+class CommandError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='pypass',
+        description='Run without arguments for the interactive menu. '
+                    'Put --profile first to record a performance trace.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    get = commands.add_parser('get', help='print the password of an entry')
+    get.add_argument('site')
+    get.add_argument('username', nargs='?')
+    get.add_argument('-c', '--copy', action='store_true',
+                     help='copy to the clipboard instead of printing')
+
+    add = commands.add_parser('add', help='store a new entry')
+    add.add_argument('site')
+    add.add_argument('username')
+    add_policy_arguments(add)
+    add.add_argument('--stdin', action='store_true',
+                     help='read an existing password from stdin')
+
+    generate = commands.add_parser('generate',
+                                   help='print new passwords without '
+                                        'storing them')
+    add_policy_arguments(generate)
+    generate.add_argument('-n', '--count', type=int, default=1,
+                          help='number of passwords to print')
+
+    search = commands.add_parser('search', help='fuzzy search entries')
+    search.add_argument('query')
+
+    commands.add_parser('ls', help='list all entries')
+
+    convert = commands.add_parser('convert',
+                                  help='move the vault to another storage '
+                                       'backend')
+    convert.add_argument('backend', choices=['sqlite', 'log'])
+
+    commands.add_parser('passwd', help='change the master password and '
+                                       're-encrypt every entry')
+
+    calibrate = commands.add_parser('calibrate',
+                                    help='tune the key derivation to this '
+                                         'machine and re-encrypt the vault')
+    calibrate.add_argument('--kdf', choices=['pbkdf2', 'scrypt', 'argon2id'],
+                           help='key derivation function, argon2id when '
+                                'available and scrypt otherwise')
+    calibrate.add_argument('--target', type=float,
+                           default=KDF_TARGET_SECONDS,
+                           help='seconds an unlock should take')
+    calibrate.add_argument('--dry-run', action='store_true',
+                           help='only print the chosen parameters')
+
+    audit = commands.add_parser('audit', help='report breached, reused and '
+                                              'weak passwords')
+    audit.add_argument('--breaches', metavar='FILE',
+                       help='offline SHA-1 breach list ordered by hash, '
+                            'as downloaded from Have I Been Pwned')
+
+    sync = commands.add_parser('sync', help='merge with another copy of '
+                                            'the vault')
+    sync.add_argument('vault', help='path to the other ' + DATABASE_FILE)
+    sync.add_argument('-i', '--interactive', action='store_true',
+                      help='ask which side to keep when an entry differs '
+                           'between the vaults, instead of keeping the '
+                           'newer one')
+    sync.add_argument('--dry-run', action='store_true',
+                      help='only list what would change')
+
+    rm = commands.add_parser('rm', help='delete an entry')
+    rm.add_argument('site')
+    rm.add_argument('username')
+    return parser
+
+
+def add_policy_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('-l', '--length', type=int,
+                        default=DEFAULT_PASSWORD_LENGTH,
+                        help='length of the generated password')
+    parser.add_argument('-s', '--symbols', action='store_true',
+                        help='include punctuation characters')
+    parser.add_argument('--no-digits', action='store_true')
+    parser.add_argument('--min-each', type=int, default=0,
+                        help='minimum characters from every class used')
+    parser.add_argument('--exclude-similar', action='store_true',
+                        help='leave out look-alike characters such as '
+                             'l, 1 and O')
+    parser.add_argument('-w', '--words', type=int, default=0,
+                        help='generate a passphrase of this many words')
+    parser.add_argument('--wordlist',
+                        help='file with one passphrase word per line')
+
+
+def build_policy(options: argparse.Namespace) -> passwords.Policy:
+    import passwords
+    wordlist = None
+    if options.wordlist:
+        try:
+            with open(options.wordlist) as file:
+                wordlist = sorted({line.strip() for line in file
+                                   if line.strip()})
+        except OSError as error:
+            raise CommandError("Cannot read word list: " + str(error))
+    policy = passwords.Policy(options.length, symbols=options.symbols,
+                              digits=not options.no_digits,
+                              exclude_similar=options.exclude_similar,
+                              words=options.words, wordlist=wordlist)
+    policy.minimums = {name: options.min_each for name in policy.classes}
+    try:
+        policy.validate()
+    except passwords.PolicyError as error:
+        raise CommandError(str(error))
+    return policy
+
+
+def open_database() -> storage.Backend:
+    import storage
+    try:
+        database = storage.open_backend()
+    except storage.StorageError as error:
+        raise CommandError(str(error))
+    if not os.path.exists(database.path):
+        raise CommandError("No password repository found. "
+                           "Run pypass without arguments to create one")
+    for notice in database.migrate():
+        print(notice, file=sys.stderr)
+    return database
+
+
+def unlock(database: storage.Backend) -> bytes:
+    import agent
+    key = agent.fetch_key(agent.vault_path())
+    if key is not None:
+        return key
+    import kdf
+    import getpass as gp
+    try:
+        entry = gp.getpass("Enter your master password []: ")
+    except EOFError:
+        raise CommandError("No master password given")
+    try:
+        key = kdf.unlock(entry, database.retrieve_password())
+    except kdf.KdfError as error:
+        raise CommandError(str(error))
+    if key is None:
+        raise CommandError("Incorrect password")
+    return key
+
+
+def normalise(text: str) -> str:
+    return text.lower().strip(" ")
+
+
+def find_account(database: storage.Backend, site: str,
+                 username: Optional[str]) -> object:
+    if username is None:
+        accounts = database.query_site(site)
+    else:
+        accounts = database.query_site_and_user(site, username).get(site, [])
+    if not accounts:
+        raise CommandError("No entry found for " + site)
+    if len(accounts) > 1:
+        raise CommandError("Several entries found for " + site + ": " +
+                           ', '.join(x.username for x in accounts))
+    return accounts[0]
+
+
+def command_get(options: argparse.Namespace) -> None:
+    database = open_database()
+    account = find_account(database, normalise(options.site),
+                           options.username and normalise(options.username))
+    key = unlock(database)
+    import encryption as enc
+    password = enc.decrypt_password(account.password, key,
+                                    account.site, account.username)
+    if options.copy:
+        import pyperclip as clip
+        clip.copy(password)
+    else:
+        print(password)
+
+
+def command_add(options: argparse.Namespace) -> None:
+    import encryption as enc
+    policy = None if options.stdin else build_policy(options)
+    database = open_database()
+    key = unlock(database)
+    if options.stdin:
+        password = sys.stdin.readline().rstrip('\n')
+    else:
+        import passwords
+        password = passwords.generate(policy)
+    site, username = normalise(options.site), normalise(options.username)
+    if not database.insert_data(site, username,
+                                enc.encrypt_password(password, key,
+                                                     site, username)):
+        raise CommandError("Item already exists")
+    if not options.stdin:
+        print(password)
+
+
+def command_generate(options: argparse.Namespace) -> None:
+    import passwords
+    for password in passwords.generate_many(options.count,
+                                            build_policy(options)):
+        print(password)
+
+
+def command_search(options: argparse.Namespace) -> None:
+    import dynamic_search as ds
+    for account in ds.fuzzy_search(normalise(options.query),
+                                   open_database()):
+        print(account.site + '\t' + account.username)
+
+
+def command_ls(options: argparse.Namespace) -> None:
+    for site, accounts in open_database().query_all_entries(passwords=False):
+        for account in accounts:
+            print(site + '\t' + account.username)
+
+
+def command_passwd(options: argparse.Namespace) -> None:
+    import rekey
+    import getpass as gp
+    database = open_database()
+    try:
+        old_password = gp.getpass("Enter your current master password []: ")
+        new_password = gp.getpass("Enter a new master password []: ")
+        confirmation = gp.getpass("Re-enter the new password []: ")
+    except EOFError:
+        raise CommandError("No master password given")
+    if new_password != confirmation:
+        raise CommandError("Passwords do not match")
+    try:
+        rekey.change_master_password(database, old_password, new_password)
+    except rekey.RekeyError as error:
+        raise CommandError(str(error))
+    print("Master password changed")
+
+
+def command_calibrate(options: argparse.Namespace) -> None:
+    import kdf
+    algorithm = options.kdf or kdf.default_algorithm()
+    if options.target <= 0:
+        raise CommandError("The target must be positive")
+    try:
+        params = kdf.calibrate(algorithm, options.target)
+    except kdf.KdfError as error:
+        raise CommandError(str(error))
+    print("Chosen " + algorithm + ' ' + kdf.format_params(params) +
+          ", about " +
+          format(kdf.timing(algorithm, params), '.2f') + "s per unlock")
+    if options.dry_run:
+        return None
+    import rekey
+    import getpass as gp
+    database = open_database()
+    print("Current: " + kdf.describe(database.retrieve_password()))
+    try:
+        password = gp.getpass("Enter your master password []: ")
+    except EOFError:
+        raise CommandError("No master password given")
+    try:
+        rekey.change_master_password(database, password, password,
+                                     algorithm=algorithm, params=params)
+    except rekey.RekeyError as error:
+        raise CommandError(str(error))
+    print("Vault re-encrypted with the new parameters")
+
+
+def command_convert(options: argparse.Namespace) -> None:
+    import storage
+    source = open_database()
+    target_path = storage.vault_file(options.backend)
+    if os.path.abspath(target_path) == os.path.abspath(source.path):
+        raise CommandError("The vault already uses the " + options.backend +
+                           " backend")
+    if os.path.exists(target_path):
+        raise CommandError(target_path + " already exists")
+    target = storage.open_backend(options.backend)
+    target.create_database()
+    target.migrate()
+    count = storage.copy_vault(source, target)
+    source.close()
+    target.close()
+    os.replace(source.path, source.path + '.bak')
+    print("Moved " + str(count) + " entries to " + target_path +
+          ", the old vault was kept as " + source.path + '.bak')
+
+
+def command_audit(options: argparse.Namespace) -> None:
+    import audit
+    database = open_database()
+    key = unlock(database)
+    path = options.breaches or audit.breach_list_path()
+    try:
+        breaches = audit.BreachList(path) if path else None
+    except audit.AuditError as error:
+        raise CommandError(str(error))
+    try:
+        report = audit.audit_vault(database, key, breaches)
+    finally:
+        if breaches is not None:
+            breaches.close()
+    print('\n'.join(audit.report_lines(report, breaches is not None)))
+
+
+def command_sync(options: argparse.Namespace) -> None:
+    import sync
+    import storage
+    database = open_database()
+    try:
+        other, notices = sync.open_vault(options.vault)
+    except sync.SyncError as error:
+        raise CommandError(str(error))
+    try:
+        for notice in notices:
+            print(options.vault + ': ' + notice, file=sys.stderr)
+        if not isinstance(database, type(other)):
+            raise CommandError("Only sqlite vaults can be synced. Run "
+                               "pypass convert sqlite first")
+        if os.path.samefile(other.path, database.path):
+            raise CommandError("Cannot sync a vault with itself")
+        key = unlock(database)
+        other_key = key
+        header = other.retrieve_password()
+        if header != database.retrieve_password():
+            import kdf
+            import getpass as gp
+            try:
+                entry = gp.getpass("Enter the master password of " +
+                                   options.vault + " []: ")
+                other_key = kdf.unlock(entry, header)
+            except EOFError:
+                raise CommandError("No master password given")
+            except kdf.KdfError as error:
+                raise CommandError(str(error))
+            if other_key is None:
+                raise CommandError("Incorrect password")
+        resolve = choose_side if options.interactive else None
+        report = sync.merge(database, other, key, other_key, resolve,
+                            options.dry_run)
+    except storage.StorageError as error:
+        raise CommandError(str(error))
+    finally:
+        other.close()
+    print('\n'.join(sync.report_lines(report, options.dry_run)))
+
+
+def choose_side(local: storage.SyncRow,
+                remote: storage.SyncRow) -> storage.SyncRow:
+    import sync
+    newer = sync.newest(local, remote)
+    print(local.site + '  ' + local.username + ' differs between the vaults')
+    print('    [l]ocal:  ' + sync.describe_row(local))
+    print('    [r]emote: ' + sync.describe_row(remote))
+    while True:
+        try:
+            answer = input("Keep which? (Enter keeps the newer): ")
+        except EOFError:
+            raise CommandError("Sync cancelled, nothing was changed")
+        answer = answer.strip().lower()
+        if not answer:
+            return newer
+        if answer in ('l', 'local'):
+            return local
+        if answer in ('r', 'remote'):
+            return remote
+
+
+def command_rm(options: argparse.Namespace) -> None:
+    database = open_database()
+    site, username = normalise(options.site), normalise(options.username)
+    find_account(database, site, username)
+    unlock(database)
+    database.delete_row(site, username)
+
+
+COMMANDS = {
+    'get': command_get,
+    'add': command_add,
+    'generate': command_generate,
+    'search': command_search,
+    'ls': command_ls,
+    'convert': command_convert,
+    'passwd': command_passwd,
+    'calibrate': command_calibrate,
+    'audit': command_audit,
+    'sync': command_sync,
+    'rm': command_rm,
+}
+
+
+def main(args: list) -> int:
+    options = build_parser().parse_args(args)
+    try:
+        COMMANDS[options.command](options)
+    except CommandError as error:
+        print('[Error]: ' + str(error), file=sys.stderr)
+        return 1
+    return 0
@@ -9,3 +9,55 @@ LEFT = '\\D'
 SENSITIVITY = 4
 UPPER = string.ascii_uppercase
 LOWER = string.ascii_lowercase
+STREAM_CHUNK_SIZE = 500
+CRYPTO_CHUNK_SIZE = 256
+IMPORT_CHUNK_SIZE = 500
+DATABASE_FILE = 'account_database.db'
+AGENT_TIMEOUT = 900
+DEFAULT_PASSWORD_LENGTH = 16
+RIGHT = '\\C'
+ESC_TIMEOUT = 0.05
+CANCEL_CHECK_INTERVAL = 256
+RESULT_LIMIT = 20
+DIGITS = string.digits
+SYMBOLS = '!#$%&()*+,-./:;<=>?@[]^_{|}~'
+LOOKALIKES = 'Il1|O0o'
+CONSONANTS = 'bdfghjklmnprstvz'
+VOWELS = 'aeiou'
+SYLLABLES_PER_WORD = 3
+ENTROPY_BUFFER_SIZE = 4096
+REKEY_CHUNK_SIZE = 4096
+SQLITE_BUSY_TIMEOUT = 30
+SQLITE_PRAGMAS = ('journal_mode=WAL', 'synchronous=NORMAL',
+                  'cache_size=-16000', 'temp_store=MEMORY')
+LOG_VAULT_FILE = 'account_vault.log'
+BACKEND_VARIABLE = 'PYPASS_BACKEND'
+LOG_INDEX_INTERVAL = 1000
+LOG_COMPACT_MIN = 1000
+PROFILE_FLAG = '--profile'
+TRACE_FILE = 'pypass-trace-%d.json'
+PROFILE_PERCENTILES = (50, 90, 99)
+AUDIT_CHUNK_SIZE = 1024
+AUDIT_MIN_ENTROPY = 64
+LEGACY_BITS_PER_CHAR = 4.24
+BREACH_LIST_FILE = 'pwned-passwords-sha1-ordered-by-hash.txt'
+BREACH_LIST_VARIABLE = 'PYPASS_BREACH_LIST'
+KDF_PREFIX = b'pypass'
+KDF_SALT_SIZE = 16
+KDF_DEFAULTS = {'pbkdf2': {'i': 600000},
+                'scrypt': {'n': 65536, 'r': 8, 'p': 1},
+                'argon2id': {'t': 3, 'm': 65536, 'p': 1}}
+KDF_MINIMUMS = {'pbkdf2': {'i': 100000},
+                'scrypt': {'n': 16384, 'r': 8, 'p': 1},
+                'argon2id': {'t': 1, 'm': 65536, 'p': 1}}
+KDF_CALIBRATION_RUNS = 3
+KDF_TARGET_SECONDS = 0.5
+SCRYPT_MAX_MEMORY = 1 << 28
+RECORD_KEY_VERSION = 1
+RECORD_NONCE_SIZE = 12
+RECORD_UPGRADE_BATCH = 500
+RECORD_UPGRADE_LIMIT = 5000
+SYNC_BUCKET_BITS = 12
+SYNC_DIGEST_BITS = 48
+SYNC_FANOUT = 16
+SYNC_QUERY_CHUNK = 500
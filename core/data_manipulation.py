@@ -1,97 +1,108 @@
 import os
-import bcrypt
 import time
 import passwords
-import getch
+import screen
+import importer
+import kdf
+import audit
+import rekey
 import encryption as enc
 import pyperclip as clip
 import dynamic_search as ds
 import getpass as gp
-import database as db
+import storage
+from constants import STREAM_CHUNK_SIZE
 
 
-def create_database(database: db.Database) -> bool:
-    if not os.path.exists('./account_database.db'):
-        os.system('tput civis')
+def create_database(database: storage.Backend) -> bool:
+    if not os.path.exists(database.path):
+        screen.hide_cursor()
         input("Welcome to pypass!\n" +
               "Let's begin by creating a master password\n" +
               "Please ensure it's memorable but secure\n" +
               "\nPress Enter to continue...")
         database.create_database()
-        os.system('tput cnorm')
-        os.system('clear')
+        screen.show_cursor()
+        screen.clear()
         return False
     print("Pypass\n\n" + "Accessing password repository...")
     return True
 
 
-def handle_password(trigger: bool, database: db.Database) -> str:
+def handle_password(trigger: bool, database: storage.Backend) -> bytes:
     if trigger:
         entry = gp.getpass("Enter your master password []: ")
-        if not bcrypt.checkpw(entry.encode(),
-                              database.retrieve_password()):
+        key = kdf.unlock(entry, database.retrieve_password())
+        if key is None:
             raise Exception("[Error] Incorrect password")
-        return entry
+        return key
 
     while True:
         first_entry = gp.getpass("Enter a master password []: ")
         second_entry = gp.getpass("Re-enter the password []: ")
         if first_entry == second_entry:
-            database.set_password(enc.hash_password(first_entry))
-            return first_entry
+            header, key = kdf.create(first_entry)
+            database.set_password(header)
+            return key
         print("\n[Error] Passwords do not match")
         time.sleep(1.3)
-        os.system('clear')
+        screen.clear()
 
 
-def show_search(database: db.Database, key: bytes) -> None:
+def show_search(database: storage.Backend, key: bytes) -> None:
     if not ds.check_database_empty(database):
-        search_result = ds.user_enter_query(database)
-        if search_result == '\x1b':
+        results = ds.user_enter_query(database)
+        if results is None:
             return None
-        results = ds.fuzzy_search(search_result, database)
-        op = ds.build_menu_options(results)
-        if len(op) == 1:
-            clip.copy(enc.decrypt_password(op[1].password, key))
-        else:
-            os.system('tput cnorm')
-            while True:
-                usr_input = getch.Getch()()
-                if usr_input.isnumeric() and int(usr_input) <= len(op):
-                    pw = enc.decrypt_password(op[int(usr_input)].password, key)
-                    clip.copy(pw)
-                    break
-
-        os.system('tput civis')
-        os.system('clear')
+        selection = ds.select_option(ds.build_menu_options(results))
+        clip.copy(enc.decrypt_password(
+            database.fetch_password(selection.id), key,
+            selection.site, selection.username))
+
+        screen.hide_cursor()
+        screen.clear()
         print("Password copied to clipboard")
         time.sleep(1)
 
 
-def show_all(database: db.Database, key: bytes) -> None:
-    queries = database.query_all_entries()
-    if not queries:
+def show_all(database: storage.Backend, key: bytes) -> None:
+    found = False
+    batch, batch_size = [], 0
+    for site, accounts in database.query_all_entries():
+        found = True
+        batch.append((site, accounts))
+        batch_size += len(accounts)
+        if batch_size >= STREAM_CHUNK_SIZE:
+            print_account_tree(batch, key)
+            batch, batch_size = [], 0
+    print_account_tree(batch, key)
+    if not found:
         print("No items found\n")
-    else:
-        for site in queries:
-            print(site)
-            for item in queries[site][:-1]:
-                print('    ├── ' + item.username +
-                      '\n    │   └── ' +
-                      enc.decrypt_password(item.password, key))
-            print('    └── ' + queries[site][-1].username +
-                  '\n        └── ' +
-                  enc.decrypt_password(queries[site][-1].password, key))
-
-
-def input_data(database: db.Database, key: bytes) -> None:
-    os.system('tput cnorm')
+
+
+def print_account_tree(groups: list, key: bytes) -> None:
+    decrypted = iter(enc.decrypt_passwords(
+        ((item.site, item.username, item.password)
+         for _, accounts in groups for item in accounts), key))
+    for site, accounts in groups:
+        print(site)
+        for item in accounts[:-1]:
+            print('    ├── ' + item.username +
+                  '\n    │   └── ' +
+                  next(decrypted))
+        print('    └── ' + accounts[-1].username +
+              '\n        └── ' +
+              next(decrypted))
+
+
+def input_data(database: storage.Backend, key: bytes) -> None:
+    screen.show_cursor()
     site = input("\nEnter website []: ").lower().strip(" ")
     username = input("Enter account username []: ").lower().strip(" ")
 
     if database.query_site_and_user(site, username) != {}:
-        os.system('clear')
-        os.system('tput civis')
+        screen.clear()
+        screen.hide_cursor()
         print("[Error]: Item already exists")
         time.sleep(1.3)
     else:
@@ -99,98 +110,179 @@ def input_data(database: db.Database, key: bytes) -> None:
             length = input("Generate password of length []: ")
             if length.isnumeric():
                 password = passwords.generate_password(int(length))
-                database.insert_data(site,
-                                     username,
-                                     enc.encrypt_password(password,
-                                                          key))
+                inserted = database.insert_data(site,
+                                                username,
+                                                enc.encrypt_password(
+                                                    password, key,
+                                                    site, username))
+                screen.clear()
+                screen.hide_cursor()
+                if not inserted:
+                    print("[Error]: Item already exists")
+                    time.sleep(1.3)
+                    return None
                 clip.copy(password)
-                os.system('clear')
-                os.system('tput civis')
                 print("Password copied to clipboard")
                 time.sleep(1)
                 return None
 
 
-def input_existing_data(database: db.Database, key: bytes) -> None:
-    os.system('tput cnorm')
+def input_existing_data(database: storage.Backend, key: bytes) -> None:
+    screen.show_cursor()
     site = input("\nEnter website []: ").lower().strip(" ")
     username = input("Enter account username []: ").lower().strip(" ")
 
     if database.query_site_and_user(site, username) != {}:
-        os.system('tput civis')
-        os.system('clear')
+        screen.hide_cursor()
+        screen.clear()
         print("[Error]: Item already exists")
         time.sleep(1.3)
     else:
         password = input("Enter password []: ")
-        database.insert_data(site,
-                             username,
-                             enc.encrypt_password(password, key))
-        os.system('tput civis')
-        os.system('clear')
-        print("Account information stored")
+        inserted = database.insert_data(site,
+                                        username,
+                                        enc.encrypt_password(password, key,
+                                                             site, username))
+        screen.hide_cursor()
+        screen.clear()
+        if not inserted:
+            print("[Error]: Item already exists")
+        else:
+            print("Account information stored")
+        time.sleep(1.3)
+
+
+def import_data(database: storage.Backend, key: bytes) -> None:
+    screen.show_cursor()
+    path = input("\nEnter path of export file []: ").strip(" ")
+    source = input("Exported from (bitwarden/keepass/generic) []: ").\
+        lower().strip(" ")
+    mapping = None
+    if source == 'generic':
+        mapping = {field: input("Enter " + field + " column []: ")
+                   for field in ('site', 'username', 'password')}
+    try:
+        stats = importer.import_file(path, source, database, key,
+                                     mapping, print_import_progress)
+    except (OSError, importer.ImportFileError,
+            storage.StorageError) as error:
+        screen.hide_cursor()
+        screen.clear()
+        print("[Error]: Import failed\n" + str(error))
         time.sleep(1.3)
+        return None
+    screen.hide_cursor()
+    screen.clear()
+    print("Imported " + str(stats.imported) + " entries, skipped " +
+          str(stats.skipped) + " in " + format(stats.elapsed, '.1f') +
+          "s (" + format(stats.rate, '.0f') + " entries/s)")
+    input("\nPress Enter to continue...")
 
 
-def update_data(database: db.Database, key: bytes) -> None:
+def print_import_progress(stats: importer.ImportStats) -> None:
+    print("\rProcessed " + str(stats.imported + stats.skipped) +
+          " entries (" + format(stats.rate, '.0f') + " entries/s)",
+          end='', flush=True)
+
+
+def update_data(database: storage.Backend, key: bytes) -> None:
     if not ds.check_database_empty(database):
-        search_result = ds.user_enter_query(database)
-        if search_result == '\x1b':
+        results = ds.user_enter_query(database)
+        if results is None:
             return None
-        results = ds.fuzzy_search(search_result, database)
-        op = ds.build_menu_options(results)
-        if len(op) == 1:
-            selection = op[1]
-        else:
-            while True:
-                usr_input = getch.Getch()()
-                if usr_input.isnumeric() and int(usr_input) <= len(op):
-                    selection = op[int(usr_input)]
-                    break
+        selection = ds.select_option(ds.build_menu_options(results))
         user_input = int(input("Enter length of new password []: "))
         password = passwords.generate_password(user_input)
-        new_password = enc.encrypt_password(password, key)
+        new_password = enc.encrypt_password(password, key, selection.site,
+                                            selection.username)
         database.update_item(selection.site,
                              selection.username,
                              new_password)
-        os.system('clear')
+        screen.clear()
         print("Password copied to clipboard")
         time.sleep(1)
-        os.system('tput civis')
+        screen.hide_cursor()
 
 
-def delete_data(database: db.Database) -> None:
+def delete_data(database: storage.Backend) -> None:
     if not ds.check_database_empty(database):
-        search_result = ds.user_enter_query(database)
-        if search_result == '\x1b':
+        results = ds.user_enter_query(database)
+        if results is None:
             return None
-        results = ds.fuzzy_search(search_result, database)
-        op = ds.build_menu_options(results)
-        if len(op) == 1:
-            selection = op[1]
-        else:
-            while True:
-                usr_input = getch.Getch()()
-                if usr_input.isnumeric() and int(usr_input) <= len(op):
-                    selection = op[int(usr_input)]
-                    break
-        os.system('clear')
+        selection = ds.select_option(ds.build_menu_options(results))
+        screen.clear()
         database.delete_row(selection.site,
                             selection.username)
         print("Account info deleted")
         time.sleep(1.3)
 
 
-def delete_all(database: db.Database) -> None:
+def rebuild_index(database: storage.Backend) -> None:
+    print("Rebuilding search index...")
+    database.rebuild_index()
+    screen.clear()
+    print("Search index rebuilt")
+    time.sleep(1)
+
+
+def change_master_password(database: storage.Backend, key: bytes) -> bytes:
+    screen.show_cursor()
+    old_password = gp.getpass("Enter your current master password []: ")
+    new_password = gp.getpass("Enter a new master password []: ")
+    if new_password != gp.getpass("Re-enter the new password []: "):
+        screen.clear()
+        screen.hide_cursor()
+        print("[Error]: Passwords do not match. Aborted")
+        time.sleep(1.3)
+        return key
+    try:
+        key = rekey.change_master_password(database, old_password,
+                                           new_password, print_rekey_progress)
+    except rekey.RekeyError as error:
+        print("\n[Error]: " + str(error))
+        time.sleep(1.3)
+    else:
+        print("\nMaster password changed")
+        time.sleep(1)
+    screen.clear()
+    screen.hide_cursor()
+    return key
+
+
+def print_rekey_progress(done: int) -> None:
+    print("\rRe-encrypted " + str(done) + " entries", end='', flush=True)
+
+
+def delete_all(database: storage.Backend) -> None:
     password = gp.getpass("You are about to delete account info. " +
                           "This is irreversible.\n\n" +
                           "Enter your master password to confirm []: ")
-    os.system('clear')
-    if not bcrypt.checkpw(password.encode(),
-                          database.retrieve_password()):
+    screen.clear()
+    if kdf.unlock(password, database.retrieve_password()) is None:
         print("[Error]: Password incorrect. Aborted")
         time.sleep(1.3)
     else:
         database.drop_tables()
         print("All account information deleted")
         input("\nPress Enter to continue...")
+
+
+def audit_passwords(database: storage.Backend, key: bytes) -> None:
+    if ds.check_database_empty(database):
+        return None
+    breaches = None
+    path = audit.breach_list_path()
+    if path is not None:
+        try:
+            breaches = audit.BreachList(path)
+        except audit.AuditError as error:
+            print("[Error]: " + str(error))
+    print("Auditing passwords...")
+    try:
+        report = audit.audit_vault(database, key, breaches)
+    finally:
+        if breaches is not None:
+            breaches.close()
+    screen.clear()
+    print('\n'.join(audit.report_lines(report, breaches is not None)))
+    input("\nPress Enter to continue...")
@@ -1,89 +1,505 @@
+import itertools
+import contextlib
+import profiler
+import storage
 import sqlalchemy as sql
 from sqlalchemy.ext import declarative
 from sqlalchemy import orm
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from constants import DATABASE_FILE, STREAM_CHUNK_SIZE, \
+    REKEY_CHUNK_SIZE, SQLITE_BUSY_TIMEOUT, SQLITE_PRAGMAS, SYNC_QUERY_CHUNK
 
-class Database:
+LEGACY_RECORD = "hex(substr(password, 1, 1)) = '67'"
+
+
+class Database(storage.Backend):
     Base = declarative.declarative_base()
 
     class Account(Base):
         __tablename__ = 'account'
+        __table_args__ = (sql.Index('ix_account_site_username',
+                                    'site', 'username', unique=True),
+                          sql.Index('ix_account_legacy', 'id',
+                                    sqlite_where=sql.text(LEGACY_RECORD)),
+                          sql.Index('ix_account_sync', 'bucket', 'digest'))
         id = sql.Column(sql.Integer, primary_key=True)
         site = sql.Column(sql.String)
         username = sql.Column(sql.String)
+        # Binary records are stored as BLOBs; rows written before them
+        # still hold Fernet tokens as text until they are upgraded.
         password = sql.Column(sql.String)
+        # Every change bumps the version and takes a new digest, which
+        # identifies the revision when vaults are merged.
+        version = sql.Column(sql.Integer)
+        modified = sql.Column(sql.Integer)
+        bucket = sql.Column(sql.Integer)
+        digest = sql.Column(sql.Integer)
+
+    class Tombstone(Base):
+        __tablename__ = 'account_tombstone'
+        __table_args__ = (sql.Index('ix_account_tombstone_site_username',
+                                    'site', 'username', unique=True),
+                          sql.Index('ix_account_tombstone_sync',
+                                    'bucket', 'digest'))
+        id = sql.Column(sql.Integer, primary_key=True)
+        site = sql.Column(sql.String)
+        username = sql.Column(sql.String)
+        version = sql.Column(sql.Integer)
+        modified = sql.Column(sql.Integer)
+        bucket = sql.Column(sql.Integer)
+        digest = sql.Column(sql.Integer)
 
     class Password(Base):
         __tablename__ = 'password'
         id = sql.Column(sql.Integer, primary_key=True)
         password = sql.Column(sql.String)
 
-    def __init__(self) -> None:
-        self.engine = sql.create_engine('sqlite:///account_database.db')
+    path = DATABASE_FILE
+
+    def __init__(self, path: str = DATABASE_FILE) -> None:
+        super().__init__()
+        self.path = path
+        self.engine = sql.create_engine(
+            'sqlite:///' + path,
+            connect_args={'timeout': SQLITE_BUSY_TIMEOUT})
+        sql.event.listen(self.engine, 'connect', set_pragmas)
         self.Base.metadata.bind = self.engine
-        self.DBSession = orm.sessionmaker(bind=self.engine)
-        self.session = self.DBSession()
+        self.DBSession = orm.sessionmaker(bind=self.engine,
+                                          expire_on_commit=False)
+
+    @contextlib.contextmanager
+    def reading(self) -> Iterator[orm.Session]:
+        session = self.DBSession()
+        try:
+            with profiler.span('sqlite.read'):
+                yield session
+        finally:
+            session.close()
+
+    @contextlib.contextmanager
+    def writing(self) -> Iterator[orm.Session]:
+        # Writers queue on a lock file before taking SQLite's write lock
+        # up front, so a transaction never has to upgrade a read lock
+        # while another process is committing. Readers are not blocked.
+        with self.writer_lock(), profiler.span('sqlite.write'):
+            session = self.DBSession()
+            try:
+                session.execute(sql.text('BEGIN IMMEDIATE'))
+                yield session
+                session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+                self.revision += 1
+
+    def files(self) -> List[str]:
+        return [self.path, self.path + '-wal']
+
+    def close(self) -> None:
+        self.engine.dispose()
 
     def create_database(self) -> None:
-        self.Base.metadata.create_all(self.engine)
+        with self.writing() as session:
+            connection = session.connection()
+            self.Base.metadata.create_all(connection)
+            set_schema_version(connection, len(MIGRATIONS))
+
+    def migrate(self) -> List[str]:
+        notices = []
+        with self.reading() as session:
+            version = get_schema_version(session.connection())
+        if version != len(MIGRATIONS):
+            with self.writing() as session:
+                connection = session.connection()
+                version = get_schema_version(connection)
+                for migration in MIGRATIONS[version:]:
+                    notices += migration(connection) or []
+                if version != len(MIGRATIONS):
+                    set_schema_version(connection, len(MIGRATIONS))
+        return notices
 
     def insert_data(self, site: str,
-                    username: str, password: str) -> None:
-        self.session.add(self.Account(site=site,
-                                      username=username, password=password))
-        self.session.commit()
+                    username: str, password: str) -> bool:
+        with self.writing() as session:
+            versions = self.revive(session, {(site, username)})
+            account = self.Account(site=site, username=username,
+                                   password=password,
+                                   **storage.stamp(site, username,
+                                                   versions.get(
+                                                       (site, username), 1)))
+            session.add(account)
+            try:
+                session.flush()
+            except sql.exc.IntegrityError:
+                session.rollback()
+                return False
+        return True
+
+    def insert_many(self, rows: List[Tuple[str, str, str]],
+                    skip_existing: bool = False) -> int:
+        if not rows:
+            return 0
+        pairs = {(site, username) for site, username, _ in rows}
+        with self.writing() as session:
+            if skip_existing:
+                # Checked under the write lock, so an entry added since the
+                # rows were prepared is skipped rather than failing the batch.
+                existing = {(x.site, x.username) for x in self.select_pairs(
+                    session, (self.Account.id,), pairs)}
+                rows = storage.new_rows(rows, existing)
+                pairs -= existing
+                if not rows:
+                    return 0
+            versions = self.revive(session, pairs)
+            session.execute(self.Account.__table__.insert(),
+                            [dict(site=site, username=username,
+                                  password=password,
+                                  **storage.stamp(site, username,
+                                                  versions.get(
+                                                      (site, username), 1)))
+                             for site, username, password in rows])
+        return len(rows)
 
     def query_database(self) -> list:
-        return self.session.query(self.Account).all()
+        with self.reading() as session:
+            return session.query(self.Account).all()
+
+    def query_entries(self) -> List[storage.Entry]:
+        with self.reading() as session:
+            return storage.project_entries(
+                session.query(self.Account.id, self.Account.site,
+                              self.Account.username).
+                order_by(self.Account.id))
+
+    def fetch_password(self, account_id: int) -> str:
+        with self.reading() as session:
+            password = session.query(self.Account.password).\
+                filter(self.Account.id == account_id).scalar()
+        if password is None:
+            raise storage.StorageError("Item no longer exists")
+        return password
+
+    def count(self) -> int:
+        with self.reading() as session:
+            return session.query(sql.func.count(self.Account.id)).scalar()
+
+    def query_site(self, site: str) -> list:
+        with self.reading() as session:
+            return session.query(self.Account).\
+                filter(self.Account.site == site).all()
 
     def query_site_and_user(self, site: str, username: str) -> dict:
         results = {}
-        queries = self.session.query(self.Account).\
-            filter(self.Account.site == site).\
-            filter(self.Account.username == username)
-        for instance in queries:
-            if instance.site not in results:
-                results[instance.site] = [instance]
-            else:
-                results[instance.site].append(instance)
+        with self.reading() as session:
+            queries = session.query(self.Account).\
+                filter(self.Account.site == site).\
+                filter(self.Account.username == username)
+            for instance in queries:
+                if instance.site not in results:
+                    results[instance.site] = [instance]
+                else:
+                    results[instance.site].append(instance)
         return results
 
-    def query_all_entries(self) -> dict:
-        results = {}
-        query_all = self.session.query(self.Account).all()
-        sites = sorted({x.site for x in query_all})
-        for item in sites:
-            query = self.session.\
-                    query(self.Account).filter(self.Account.site == item)
-            results[item] = query
-        return results
+    def query_all_entries(self, passwords: bool = True) \
+            -> Iterator[Tuple[str, list]]:
+        columns = (self.Account,) if passwords else \
+            (self.Account.id, self.Account.site, self.Account.username)
+        with self.reading() as session:
+            query = session.query(*columns).\
+                order_by(self.Account.site, self.Account.id).\
+                yield_per(STREAM_CHUNK_SIZE)
+            for site, accounts in itertools.groupby(query,
+                                                    lambda x: x.site):
+                yield site, list(accounts)
 
     def is_empty(self) -> bool:
-        return not self.query_database()
+        with self.reading() as session:
+            return not session.query(
+                session.query(self.Account.id).exists()).scalar()
 
     def update_item(self,
                     site: str, username: str, new_password: str) -> None:
-        query = self.session.query(self.Account).\
-            filter(self.Account.site == site).\
-            filter(self.Account.username == username)
-        query[0].password = new_password
-        self.session.commit()
+        with self.writing() as session:
+            query = session.query(self.Account).\
+                filter(self.Account.site == site).\
+                filter(self.Account.username == username)
+            account = query[0]
+            account.password = new_password
+            for name, value in storage.stamp(site, username,
+                                             account.version + 1).items():
+                setattr(account, name, value)
 
     def drop_tables(self) -> None:
-        self.session.query(self.Account).delete()
-        self.session.commit()
+        with self.writing() as session:
+            self.bury(session, session.query(self.Account.site,
+                                             self.Account.username,
+                                             self.Account.version).all())
+            session.query(self.Account).delete()
 
     def delete_row(self, site: str, username: str) -> None:
-        self.session.query(self.Account).filter(self.Account.site == site).\
-            filter(self.Account.username == username).delete()
-        self.session.commit()
+        with self.writing() as session:
+            query = session.query(self.Account).\
+                filter(self.Account.site == site).\
+                filter(self.Account.username == username)
+            accounts = query.all()
+            self.bury(session, accounts)
+            query.delete()
+
+    def select_pairs(self, session: orm.Session, columns: tuple,
+                     pairs: set) -> list:
+        table = columns[0].class_
+        sites = sorted({site for site, _ in pairs})
+        found = []
+        for start in range(0, len(sites), SYNC_QUERY_CHUNK):
+            found += [row for row in session.query(
+                *columns, table.site, table.username).
+                filter(table.site.in_(sites[start:start + SYNC_QUERY_CHUNK]))
+                if (row.site, row.username) in pairs]
+        return found
+
+    def revive(self, session: orm.Session,
+               pairs: set) -> Dict[Tuple[str, str], int]:
+        # An entry added again after a deletion continues the version of
+        # its tombstone, so the new entry wins when vaults are merged.
+        tombstones = self.select_pairs(session, (self.Tombstone.id,
+                                                 self.Tombstone.version),
+                                       pairs)
+        if tombstones:
+            session.execute(self.Tombstone.__table__.delete().
+                            where(self.Tombstone.id ==
+                                  sql.bindparam('tombstone_id')),
+                            [{'tombstone_id': x.id} for x in tombstones])
+        return {(x.site, x.username): x.version + 1 for x in tombstones}
+
+    def bury(self, session: orm.Session, accounts: list) -> None:
+        rows = [dict(site=account.site, username=account.username,
+                     **storage.stamp(account.site, account.username,
+                                     account.version + 1, deleted=True))
+                for account in accounts]
+        if rows:
+            session.execute(self.Tombstone.__table__.insert(), rows)
+
+    def sync_leaves(self) -> Dict[int, Tuple[int, int]]:
+        # Each bucket is summarised by the sum and count of its digests.
+        # The sum does not depend on row order and both queries are
+        # answered from the (bucket, digest) indexes alone.
+        leaves = {}
+        with self.reading() as session:
+            for table in (self.Account, self.Tombstone):
+                for bucket, total, count in session.query(
+                        table.bucket, sql.func.sum(table.digest),
+                        sql.func.count()).group_by(table.bucket):
+                    old_total, old_count = leaves.get(bucket, (0, 0))
+                    leaves[bucket] = (old_total + total, old_count + count)
+        return leaves
+
+    def sync_rows(self, buckets: List[int]) -> List[storage.SyncRow]:
+        rows = []
+        with self.reading() as session:
+            for start in range(0, len(buckets), SYNC_QUERY_CHUNK):
+                chunk = buckets[start:start + SYNC_QUERY_CHUNK]
+                for table, password in ((self.Account,
+                                         self.Account.password),
+                                        (self.Tombstone, sql.null())):
+                    rows += [storage.SyncRow(*row) for row in session.query(
+                        table.site, table.username, table.version,
+                        table.modified, table.digest, password).
+                        filter(table.bucket.in_(chunk))]
+        return rows
+
+    def apply_sync(self, rows: List[storage.SyncRow]) -> None:
+        # Merged rows keep the version, time and digest they were written
+        # with, so both vaults end up with identical digests.
+        pairs = {(row.site, row.username) for row in rows}
+        values = [{'site': row.site, 'username': row.username,
+                   'password': row.password, 'version': row.version,
+                   'modified': row.modified, 'digest': row.digest,
+                   'bucket': storage.row_bucket(row.site, row.username)}
+                  for row in rows]
+        with self.writing() as session:
+            self.revive(session, pairs)
+            accounts = {(x.site, x.username): x.id for x in
+                        self.select_pairs(session, (self.Account.id,),
+                                          pairs)}
+            buried = [x for x in values if x['password'] is None]
+            removed = [{'account_id': accounts[x['site'], x['username']]}
+                       for x in buried
+                       if (x['site'], x['username']) in accounts]
+            updated = [dict({name + '_new': x[name] for name in
+                             ('password', 'version', 'modified', 'digest')},
+                            account_id=accounts[x['site'], x['username']])
+                       for x in values if x['password'] is not None and
+                       (x['site'], x['username']) in accounts]
+            added = [x for x in values if x['password'] is not None and
+                     (x['site'], x['username']) not in accounts]
+            if removed:
+                session.execute(self.Account.__table__.delete().where(
+                    self.Account.id == sql.bindparam('account_id')), removed)
+            if buried:
+                session.execute(self.Tombstone.__table__.insert(),
+                                [{name: value for name, value in x.items()
+                                  if name != 'password'} for x in buried])
+            if updated:
+                session.execute(self.Account.__table__.update().where(
+                    self.Account.id == sql.bindparam('account_id')).
+                    values({name: sql.bindparam(name + '_new')
+                            for name in ('password', 'version', 'modified',
+                                         'digest')}), updated)
+            if added:
+                session.execute(self.Account.__table__.insert(), added)
 
     def set_password(self, password: str) -> None:
-        self.session.add(self.Password(password=password))
-        self.session.commit()
+        with self.writing() as session:
+            session.query(self.Password).delete()
+            session.add(self.Password(password=password))
+
+    def query_legacy_records(self, limit: int) -> list:
+        with self.reading() as session:
+            return session.query(self.Account).\
+                filter(sql.text(LEGACY_RECORD)).\
+                order_by(self.Account.id).limit(limit).all()
+
+    def update_records(self, rows: List[Tuple[int, object, bytes]]) -> int:
+        with self.writing() as session:
+            result = session.connection().execute(
+                self.Account.__table__.update().
+                where(self.Account.id == sql.bindparam('account_id')).
+                where(self.Account.password == sql.bindparam('old')).
+                values(password=sql.bindparam('new')),
+                [{'account_id': account_id, 'old': old, 'new': new}
+                 for account_id, old, new in rows])
+            return result.rowcount
+
+    def rekey(self, rotate: Callable[[List[tuple]], List[bytes]],
+              password_hash: bytes,
+              progress: Optional[Callable[[int], None]] = None) -> int:
+        # The new ciphertexts are staged in a shadow table and copied over
+        # in the same transaction as the new master password hash, so the
+        # vault only ever holds passwords under one of the two keys.
+        done = 0
+        with self.writing() as session:
+            connection = session.connection()
+            connection.execute(sql.text('DROP TABLE IF EXISTS account_rekey'))
+            connection.execute(sql.text(
+                'CREATE TABLE account_rekey '
+                '(id INTEGER PRIMARY KEY, password VARCHAR)'))
+            rows = connection.execute(sql.text(
+                'SELECT id, site, username, password FROM account '
+                'ORDER BY id'))
+            while True:
+                chunk = rows.fetchmany(REKEY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                rotated = rotate([tuple(row[1:]) for row in chunk])
+                connection.execute(
+                    sql.text('INSERT INTO account_rekey (id, password) '
+                             'VALUES (:id, :password)'),
+                    [{'id': row[0], 'password': password}
+                     for row, password in zip(chunk, rotated)])
+                done += len(chunk)
+                if progress is not None:
+                    progress(done)
+            connection.execute(sql.text(
+                'UPDATE account SET password = (SELECT password FROM '
+                'account_rekey WHERE account_rekey.id = account.id)'))
+            connection.execute(sql.text('DROP TABLE account_rekey'))
+            connection.execute(self.Password.__table__.delete())
+            connection.execute(self.Password.__table__.insert(),
+                               {'password': password_hash})
+        return done
 
     def retrieve_password(self) -> bytes:
-        query = self.session.query(self.Password).all()
+        with self.reading() as session:
+            query = session.query(self.Password).all()
         try:
             return query[0].password
         except:
             raise Exception("Master password was not saved on initialization. Delete account_database.db")
+
+
+def set_pragmas(connection: object, record: object) -> None:
+    cursor = connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA ' + pragma)
+    cursor.close()
+
+
+def get_schema_version(connection: sql.engine.Connection) -> int:
+    return connection.execute(sql.text('PRAGMA user_version')).scalar()
+
+
+def set_schema_version(connection: sql.engine.Connection,
+                       version: int) -> None:
+    connection.execute(sql.text('PRAGMA user_version = %d' % version))
+
+
+def drop_gram_index(connection: sql.engine.Connection) -> None:
+    # Fuzzy queries allow so many edits that the gram postings hardly
+    # ever narrowed a search, while they multiplied the size of the vault.
+    connection.execute(sql.text('DROP TABLE IF EXISTS account_gram'))
+
+
+def add_account_indexes(connection: sql.engine.Connection) -> List[str]:
+    # Older versions could store one site and username twice. The later
+    # copies are renamed rather than dropped, so no password is lost.
+    # Their tokens predate binary records and do not bind the username.
+    accounts = connection.execute(sql.text(
+        'SELECT id, site, username FROM account ORDER BY id')).fetchall()
+    taken = {(site, username) for _, site, username in accounts}
+    seen, notices = set(), []
+    for account_id, site, username in accounts:
+        if (site, username) not in seen:
+            seen.add((site, username))
+            continue
+        copy = 2
+        while (site, username + ' (duplicate %d)' % copy) in taken:
+            copy += 1
+        renamed = username + ' (duplicate %d)' % copy
+        taken.add((site, renamed))
+        connection.execute(sql.text(
+            'UPDATE account SET username = :username WHERE id = :id'),
+            {'username': renamed, 'id': account_id})
+        notices.append("Renamed a duplicate of " + site + " / " + username +
+                       " to " + renamed)
+    connection.execute(sql.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_account_site_username '
+        'ON account (site, username)'))
+    return notices
+
+
+def add_legacy_index(connection: sql.engine.Connection) -> None:
+    connection.execute(sql.text(
+        'CREATE INDEX IF NOT EXISTS ix_account_legacy ON account (id) '
+        'WHERE ' + LEGACY_RECORD))
+
+
+def add_sync_columns(connection: sql.engine.Connection) -> None:
+    # Rows from before versioning are fingerprinted by their ciphertext,
+    # so copies of one vault agree on every entry neither side changed.
+    for column in ('version', 'modified', 'bucket', 'digest'):
+        connection.execute(sql.text(
+            'ALTER TABLE account ADD COLUMN %s INTEGER' % column))
+    Database.Tombstone.__table__.create(connection, checkfirst=True)
+    accounts = connection.execute(
+        sql.text('SELECT id, site, username, password FROM account'))
+    rows = [{'account_id': account_id,
+             'bucket': storage.row_bucket(site, username),
+             'digest': storage.row_digest(site, username, password)}
+            for account_id, site, username, password in accounts]
+    if rows:
+        connection.execute(sql.text(
+            'UPDATE account SET version = 0, modified = 0, '
+            'bucket = :bucket, digest = :digest WHERE id = :account_id'),
+            rows)
+    connection.execute(sql.text(
+        'CREATE INDEX IF NOT EXISTS ix_account_sync '
+        'ON account (bucket, digest)'))
+
+
+# The first version added a gram index that was later dropped, so its
+# slot drops the table as well.
+MIGRATIONS = [drop_gram_index, add_account_indexes, add_legacy_index,
+              add_sync_columns, drop_gram_index]
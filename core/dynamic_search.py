@@ -1,39 +1,216 @@
 import os
+import heapq
 import search
-import database as db
-from getch import Getch
-from constants import ENTER, BACKSPC, ESC
-
-
-def user_enter_query(database: db.Database) -> str:
-    os.system('tput civis')
-    user_search = ''
-
-    while True:
-        os.system('clear')
-        print('Enter search: ' + user_search + '█')
-        results = fuzzy_search(user_search, database)
-        print('━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━')
-        project_menu_tree(results)
-
-        input_char = Getch()()
-        if input_char == ENTER and results != []:
-            if len(results) > 1:
-                os.system('clear')
-                project_options_menu(build_menu_options(results))
-            break
-        elif input_char == ENTER and results == []:
-            continue
-        elif input_char == BACKSPC and user_search == '':
-            pass
-        elif input_char == BACKSPC and user_search != '':
-            user_search = user_search[:-1]
-        elif input_char == ESC:
-            return ESC
-        elif input_char.isprintable():
-            user_search += input_char.lower()
+import select
+import profiler
+import screen
+import threading
+import vector_search
+import storage
+from getch import KeyReader
+from typing import Callable, Optional
+from screen import CLEAR_LINE
+from constants import ENTER, BACKSPC, ESC, CANCEL_CHECK_INTERVAL, \
+    RESULT_LIMIT
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+class SearchSession:
+
+    def __init__(self, database: storage.Backend) -> None:
+        self.index = database.search_index() if vector_search.AVAILABLE \
+            else None
+        self.candidates = self.index.accounts if self.index \
+            else database.query_entries()
+        self.query = ''
+        self.history = [('', self.candidates)]
+
+    @property
+    def results(self) -> list:
+        return self.history[-1][1]
+
+    def append(self, text: str,
+               cancelled: Optional[Callable[[], bool]] = None) -> list:
+        if all(search.refines(self.query + text[:i])
+               for i in range(len(text))):
+            pool = self.results
+        else:
+            pool = self.candidates
+        query = self.query + text
+        results = self.scan(query, cancelled) if pool is self.candidates \
+            else filter_accounts(query, pool, cancelled)
+        self.query = query
+        self.history.append((query, results))
+        return self.results
+
+    def truncate(self, length: int,
+                 cancelled: Optional[Callable[[], bool]] = None) -> list:
+        query = self.query[:length]
+        kept = len(self.history)
+        while len(self.history[kept - 1][0]) > len(query):
+            kept -= 1
+        results = None
+        if self.history[kept - 1][0] != query:
+            results = self.scan(query, cancelled)
+        self.query = query
+        del self.history[kept:]
+        if results is not None:
+            self.history.append((query, results))
+        return self.results
+
+    def scan(self, query: str,
+             cancelled: Optional[Callable[[], bool]] = None) -> list:
+        if self.index is None:
+            return filter_accounts(query, self.candidates, cancelled)
+        if cancelled is not None and cancelled():
+            raise SearchCancelled
+        profiler.count('search.candidates', len(self.candidates))
+        return self.index.search(query)
+
+    def backspace(self) -> list:
+        return self.truncate(len(self.query) - 1) if self.query \
+            else self.results
+
+    def move_to(self, query: str,
+                cancelled: Optional[Callable[[], bool]] = None) -> list:
+        prefix = os.path.commonprefix([self.query, query])
+        if len(prefix) < len(self.query):
+            self.truncate(len(prefix), cancelled)
+        if len(query) > len(prefix):
+            self.append(query[len(prefix):], cancelled)
+        return self.results
+
+
+class SearchWorker:
+
+    def __init__(self, session: SearchSession) -> None:
+        self.session = session
+        self.condition = threading.Condition()
+        self.target = session.query
+        self.generation = 0
+        self.latest = (session.query, rank_accounts(session.query,
+                                                    session.results))
+        self.stopped = False
+        self.wake_fd, self.notify_fd = os.pipe()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, query: str) -> None:
+        with self.condition:
+            if query != self.target:
+                self.target = query
+                self.generation += 1
+                self.condition.notify_all()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.stopped and \
+                        self.target == self.latest[0]:
+                    self.condition.wait()
+                if self.stopped:
+                    return None
+                target, generation = self.target, self.generation
+            try:
+                with profiler.span('search.keystroke',
+                                   {'length': len(target)}):
+                    results = rank_accounts(target, self.session.move_to(
+                        target, lambda: self.stopped or
+                        self.generation != generation))
+            except SearchCancelled:
+                continue
+            except Exception as error:
+                # Kept in place of the results so that callers raise it
+                # instead of waiting for results that never come.
+                results = error
+            with self.condition:
+                self.latest = (target, results)
+                self.condition.notify_all()
+            os.write(self.notify_fd, b'.')
+
+    def wait(self, query: str) -> list:
+        self.submit(query)
+        with self.condition:
+            while self.latest[0] != query:
+                self.condition.wait()
+            return self.results()
 
-    return user_search
+    def results(self) -> list:
+        results = self.latest[1]
+        if isinstance(results, Exception):
+            raise results
+        return results
+
+    def acknowledge(self) -> None:
+        while select.select([self.wake_fd], [], [], 0)[0]:
+            os.read(self.wake_fd, 4096)
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        os.close(self.wake_fd)
+        os.close(self.notify_fd)
+
+
+def user_enter_query(database: storage.Backend) -> Optional[list]:
+    # The numbers a user selects by index the list drawn here, so it is
+    # returned as it was shown rather than searched again.
+    screen.hide_cursor()
+    worker = SearchWorker(SearchSession(database))
+    query = ''
+
+    try:
+        with KeyReader() as reader:
+            while True:
+                worker.acknowledge()
+                results = worker.results()
+                screen.draw(['Enter search: ' + query + '█',
+                             '━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━'] +
+                            menu_tree_lines(results))
+
+                for input_char in reader.read_keys(worker.wake_fd):
+                    if input_char == ENTER:
+                        results = worker.wait(query)
+                        if results == []:
+                            continue
+                        if len(results) > 1:
+                            screen.clear()
+                            project_options_menu(build_menu_options(results))
+                        return results
+                    elif input_char == BACKSPC:
+                        query = query[:-1]
+                    elif input_char == ESC:
+                        return None
+                    elif input_char.isprintable() and len(input_char) == 1:
+                        query += input_char.lower()
+                worker.submit(query)
+    finally:
+        worker.stop()
+
+
+def select_option(menu_options: dict) -> object:
+    if len(menu_options) == 1:
+        return menu_options[1]
+    screen.show_cursor()
+    number = ''
+    with KeyReader() as reader:
+        while True:
+            screen.screen.write('\rSelect []: ' + number + CLEAR_LINE)
+            for input_char in reader.read_keys():
+                if input_char.isdigit() and \
+                        0 < int(number + input_char) <= len(menu_options):
+                    number += input_char
+                elif input_char == BACKSPC:
+                    number = number[:-1]
+                elif input_char == ENTER and number:
+                    return menu_options[int(number)]
+            if number and int(number) * 10 > len(menu_options):
+                return menu_options[int(number)]
 
 
 def project_options_menu(menu_options: dict) -> None:
@@ -48,17 +225,17 @@ def project_options_menu(menu_options: dict) -> None:
                   menu_options[item].username)
 
 
-def project_menu_tree(results: list) -> None:
+def menu_tree_lines(results: list) -> list:
     tree = list_to_dict(results)
     if not tree:
-        print("Nothing found")
-    else:
-        for site in tree:
-            print(site)
-            for item in tree[site][:-1]:
-                print('    ├── ' + item)
-
-            print('    └── ' + tree[site][-1])
+        return ["Nothing found"]
+    lines = []
+    for site in tree:
+        lines.append(site)
+        for item in tree[site][:-1]:
+            lines.append('    ├── ' + item)
+        lines.append('    └── ' + tree[site][-1])
+    return lines
 
 
 def list_to_dict(lst: list) -> dict:
@@ -69,7 +246,7 @@ def build_menu_options(input_list: list) -> list:
     return {i + 1: input_list[i] for i in range(len(input_list))}
 
 
-def check_database_empty(database: db.Database) -> bool:
+def check_database_empty(database: storage.Backend) -> bool:
     if database.is_empty():
         print('Database is empty...')
         input('\nPress Enter to continue...')
@@ -77,9 +254,51 @@ def check_database_empty(database: db.Database) -> bool:
     return False
 
 
-def fuzzy_search(search_input: str, database: db.Database) -> list:
+def rank_accounts(search_input: str, accounts: list,
+                  limit: int = RESULT_LIMIT) -> list:
+    if not search_input:
+        return accounts[:limit]
+    matcher = search.compile_query(search_input)
+    heap = []
+    for index, item in enumerate(accounts):
+        site_score = matcher.score(item.site)
+        user_score = matcher.score(item.username)
+        if site_score is None and user_score is None:
+            continue
+        entry = (max(x for x in (site_score, user_score) if x is not None),
+                 -index, item)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+    return [item for _, _, item in sorted(heap, key=lambda x: x[:2],
+                                          reverse=True)]
+
+
+def fuzzy_search(search_input: str, database: storage.Backend) -> list:
+    with profiler.span('search.fuzzy'):
+        if vector_search.AVAILABLE:
+            return database.search_index().search(search_input)
+        return filter_accounts(search_input,
+                               database.query_entries())
+
+
+def filter_accounts(search_input: str, accounts: list,
+                    cancelled: Optional[Callable[[], bool]] = None) -> list:
     if not search_input:
-        return database.query_database()
-    return [item for item in database.query_database()
-            if search.is_found(search_input, item.site)
-            or search.is_found(search_input, item.username)]
+        return accounts
+    profiler.count('search.candidates', len(accounts))
+    matcher = search.compile_query(search_input)
+    if cancelled is None:
+        return [item for item in accounts
+                if matcher.matches(item.site)
+                or matcher.matches(item.username)]
+    results = []
+    for start in range(0, len(accounts), CANCEL_CHECK_INTERVAL):
+        if cancelled():
+            raise SearchCancelled
+        results += [item for item in
+                    accounts[start:start + CANCEL_CHECK_INTERVAL]
+                    if matcher.matches(item.site)
+                    or matcher.matches(item.username)]
+    return results
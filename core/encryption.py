@@ -1,9 +1,132 @@
+from __future__ import annotations
+import os
+import hmac
 import base64
-import bcrypt
-from cryptography import fernet
+import functools
+import itertools
+import profiler
+from concurrent import futures
+from cryptography import exceptions, fernet
 from cryptography.hazmat import backends
 from cryptography.hazmat import primitives
+from cryptography.hazmat.primitives.ciphers import aead
 from cryptography.hazmat.primitives.kdf import pbkdf2
+from typing import Callable, Iterable, List, Tuple, Union
+from constants import CRYPTO_CHUNK_SIZE, RECORD_KEY_VERSION, \
+    RECORD_NONCE_SIZE
+
+Token = Union[str, bytes]
+Row = Tuple[str, str, Token]
+
+
+class KeyRotation:
+
+    def __init__(self, old_key: bytes, new_key: bytes) -> None:
+        self.old_key = old_key
+        self.new_key = new_key
+        self.workers = os.cpu_count() or 1
+        self.executor = None
+
+    def __enter__(self) -> KeyRotation:
+        if self.workers > 1:
+            self.executor = futures.ProcessPoolExecutor(self.workers)
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def rotate(self, rows: List[Row]) -> List[bytes]:
+        if self.executor is None:
+            return rotate_chunk(rows, self.old_key, self.new_key)
+        chunks = [rows[i:i + CRYPTO_CHUNK_SIZE]
+                  for i in range(0, len(rows), CRYPTO_CHUNK_SIZE)]
+        results = self.executor.map(rotate_chunk, chunks,
+                                    itertools.repeat(self.old_key),
+                                    itertools.repeat(self.new_key))
+        return [result for chunk in results for result in chunk]
+
+
+class Cipher:
+
+    def __init__(self, key: bytes) -> None:
+        self.fernet = fernet.Fernet(key)
+        self.versions = {RECORD_KEY_VERSION:
+                         aead.AESGCM(record_key(key, RECORD_KEY_VERSION))}
+
+    def encrypt(self, site: str, username: str, password: str) -> bytes:
+        # A record is the key version, a random nonce and the AES-GCM
+        # output. The site and username are authenticated with it, so a
+        # record copied onto another entry fails to decrypt.
+        nonce = os.urandom(RECORD_NONCE_SIZE)
+        return bytes([RECORD_KEY_VERSION]) + nonce + \
+            self.versions[RECORD_KEY_VERSION].encrypt(
+                nonce, password.encode(), associated_data(site, username))
+
+    def decrypt(self, site: str, username: str, token: Token) -> str:
+        if is_legacy(token):
+            if isinstance(token, str):
+                token = token.encode()
+            return self.fernet.decrypt(token).decode('utf-8')
+        cipher = self.versions.get(token[0])
+        if cipher is None:
+            raise fernet.InvalidToken
+        try:
+            return cipher.decrypt(token[1:RECORD_NONCE_SIZE + 1],
+                                  token[RECORD_NONCE_SIZE + 1:],
+                                  associated_data(site, username)).\
+                decode('utf-8')
+        except exceptions.InvalidTag:
+            raise fernet.InvalidToken
+
+    def encrypt_many(self, rows: Iterable[Row]) -> List[bytes]:
+        return map_chunks(self.encrypt, rows)
+
+    def decrypt_many(self, rows: Iterable[Row]) -> List[str]:
+        return map_chunks(self.decrypt, rows)
+
+
+def map_chunks(func: Callable[[str, str, Token], Token],
+               items: Iterable[Row]) -> list:
+    items = list(items)
+    chunks = [items[i:i + CRYPTO_CHUNK_SIZE]
+              for i in range(0, len(items), CRYPTO_CHUNK_SIZE)]
+    workers = min(len(chunks), os.cpu_count() or 1)
+    if workers <= 1:
+        return [func(*item) for item in items]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda chunk: [func(*x) for x in chunk],
+                               chunks)
+        return [result for chunk in results for result in chunk]
+
+
+def rotate_chunk(rows: List[Row], old_key: bytes,
+                 new_key: bytes) -> List[bytes]:
+    old, new = get_cipher(old_key), get_cipher(new_key)
+    return [new.encrypt(site, username, old.decrypt(site, username, token))
+            for site, username, token in rows]
+
+
+def is_legacy(token: Token) -> bool:
+    # Fernet tokens are base64 text that always starts with "g", which
+    # is never used as a key version.
+    return isinstance(token, str) or token[:1] == b'g'
+
+
+def record_key(key: bytes, version: int) -> bytes:
+    return hmac.digest(base64.urlsafe_b64decode(key),
+                       b'record key' + bytes([version]), 'sha256')
+
+
+def associated_data(site: str, username: str) -> bytes:
+    site = site.encode()
+    return len(site).to_bytes(4, 'big') + site + username.encode()
+
+
+@functools.lru_cache(maxsize=4)
+def get_cipher(key: bytes) -> Cipher:
+    return Cipher(key)
 
 
 def key_generator(password: str) -> bytes:
@@ -15,18 +138,32 @@ def key_generator(password: str) -> bytes:
         iterations=100000,
         backend=backends.default_backend()
         )
-    return base64.urlsafe_b64encode(key_deriver.derive(password_encoded))
+    with profiler.span('pbkdf2.derive'):
+        return base64.urlsafe_b64encode(
+            key_deriver.derive(password_encoded))
+
+
+def encrypt_password(password: str, key: bytes,
+                     site: str, username: str) -> bytes:
+    with profiler.span('cipher.encrypt'):
+        return get_cipher(key).encrypt(site, username, password)
 
 
-def encrypt_password(password: str, key: bytes) -> str:
-    fernet_object = fernet.Fernet(key)
-    return fernet_object.encrypt(password.encode()).decode('utf-8')
+def decrypt_password(token: Token, key: bytes,
+                     site: str, username: str) -> str:
+    with profiler.span('cipher.decrypt'):
+        return get_cipher(key).decrypt(site, username, token)
 
 
-def decrypt_password(encrypted_pass: str, key: bytes) -> str:
-    fernet_object = fernet.Fernet(key)
-    return fernet_object.decrypt(encrypted_pass.encode()).decode('utf-8')
+def encrypt_passwords(rows: Iterable[Row], key: bytes) -> List[bytes]:
+    with profiler.span('cipher.encrypt_many'):
+        encrypted = get_cipher(key).encrypt_many(rows)
+    profiler.count('cipher.encrypted', len(encrypted))
+    return encrypted
 
 
-def hash_password(password: str) -> bytes:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+def decrypt_passwords(rows: Iterable[Row], key: bytes) -> List[str]:
+    with profiler.span('cipher.decrypt_many'):
+        decrypted = get_cipher(key).decrypt_many(rows)
+    profiler.count('cipher.decrypted', len(decrypted))
+    return decrypted
@@ -1,16 +1,131 @@
+import os
 import sys
 import tty
+import codecs
+import select
 import termios
+import contextlib
+from typing import Iterator, List, Optional
+from constants import ESC, ESC_TIMEOUT, UP, DOWN, RIGHT, LEFT
 
+ARROWS = {'A': UP, 'B': DOWN, 'C': RIGHT, 'D': LEFT}
 
-class Getch:
 
-    def __call__(self) -> None:
-        file_desc = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(file_desc)
+class KeyParser:
+
+    def __init__(self) -> None:
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = ''
+
+    def feed(self, data: bytes) -> List[str]:
+        self.pending += self.decoder.decode(data)
+        keys = []
+        while self.pending:
+            char = self.pending[0]
+            if char != ESC:
+                keys.append(char)
+                self.pending = self.pending[1:]
+                continue
+            if len(self.pending) == 1:
+                break
+            if self.pending[1] not in '[O':
+                keys.append(ESC)
+                self.pending = self.pending[1:]
+                continue
+            end = 2
+            while end < len(self.pending) and \
+                    not '@' <= self.pending[end] <= '~':
+                end += 1
+            if end == len(self.pending):
+                break
+            sequence = self.pending[:end + 1]
+            self.pending = self.pending[end + 1:]
+            keys.append(ARROWS.get(sequence[-1], sequence)
+                        if end == 2 else sequence)
+        return keys
+
+    def flush(self) -> List[str]:
+        # Whatever is still pending once the escape timeout has passed
+        # was a lone ESC press, possibly followed by ordinary keys.
+        pending, self.pending = self.pending, ''
+        return [ESC] + self.feed(pending[1:].encode()) if pending else []
+
+
+class KeyReader:
+
+    def __init__(self, file_desc: Optional[int] = None,
+                 escape_timeout: float = ESC_TIMEOUT) -> None:
+        self.file_desc = sys.stdin.fileno() if file_desc is None \
+            else file_desc
+        self.escape_timeout = escape_timeout
+        self.parser = KeyParser()
+        self.queue = []
+        self.old_settings = None
+
+    def __enter__(self) -> 'KeyReader':
+        if os.isatty(self.file_desc):
+            self.old_settings = termios.tcgetattr(self.file_desc)
+            tty.setraw(self.file_desc)
+            settings = termios.tcgetattr(self.file_desc)
+            settings[1] |= termios.OPOST
+            settings[6][termios.VMIN] = 0
+            settings[6][termios.VTIME] = 0
+            termios.tcsetattr(self.file_desc, termios.TCSADRAIN, settings)
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        if self.old_settings is not None:
+            termios.tcsetattr(self.file_desc, termios.TCSADRAIN,
+                              self.old_settings)
+            self.old_settings = None
+
+    @contextlib.contextmanager
+    def cooked(self) -> Iterator[None]:
+        # input() and getpass need the terminal's line editing, so raw
+        # mode is only left for the actions that prompt.
+        raw = self.old_settings is not None
+        self.__exit__()
         try:
-            tty.setraw(sys.stdin.fileno())
-            char = sys.stdin.read(1)
+            yield
         finally:
-            termios.tcsetattr(file_desc, termios.TCSADRAIN, old_settings)
-        return char
+            if raw:
+                self.__enter__()
+
+    def drain(self) -> bytes:
+        data = b''
+        while select.select([self.file_desc], [], [], 0)[0]:
+            chunk = os.read(self.file_desc, 4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def read_keys(self, wake_fd: Optional[int] = None) -> List[str]:
+        if self.queue:
+            keys, self.queue = self.queue, []
+            return keys
+        watched = [self.file_desc] if wake_fd is None \
+            else [self.file_desc, wake_fd]
+        keys = []
+        while not keys:
+            if self.file_desc not in select.select(watched, [], [])[0]:
+                return keys
+            data = self.drain()
+            if not data and not self.parser.pending:
+                raise EOFError
+            keys = self.parser.feed(data)
+            while self.parser.pending:
+                data = b''
+                if select.select([self.file_desc], [], [],
+                                 self.escape_timeout)[0]:
+                    data = self.drain()
+                if not data:
+                    keys += self.parser.flush()
+                    break
+                keys += self.parser.feed(data)
+        return keys
+
+    def read_key(self) -> str:
+        if not self.queue:
+            self.queue = self.read_keys()
+        return self.queue.pop(0)
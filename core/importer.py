@@ -0,0 +1,177 @@
+import re
+import csv
+import json
+import time
+import itertools
+import encryption as enc
+import storage
+from urllib import parse
+from typing import Callable, Iterator, Optional, TextIO, Tuple
+from constants import IMPORT_CHUNK_SIZE
+
+Record = Tuple[str, str, str]
+
+BITWARDEN_ITEMS = re.compile(r'"items"\s*:\s*\[')
+JSON_READ_SIZE = 1 << 16
+
+
+class ImportFileError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class ImportStats:
+
+    def __init__(self) -> None:
+        self.imported = 0
+        self.skipped = 0
+        self.start = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    @property
+    def rate(self) -> float:
+        return (self.imported + self.skipped) / max(self.elapsed, 1e-9)
+
+
+def site_from(url: str, name: str) -> str:
+    if url:
+        host = parse.urlsplit(url if '//' in url else '//' + url).hostname
+        if host:
+            return host
+    return name
+
+
+def read_bitwarden_csv(file: TextIO, mapping: dict) -> Iterator[Record]:
+    for row in csv.DictReader(file):
+        if row.get('type', 'login') == 'login':
+            yield (site_from(row.get('login_uri', ''), row.get('name', '')),
+                   row.get('login_username', ''),
+                   row.get('login_password', ''))
+
+
+def read_bitwarden_json(file: TextIO, mapping: dict) -> Iterator[Record]:
+    for item in stream_json_array(file, BITWARDEN_ITEMS):
+        login = item.get('login') or {}
+        if item.get('type') == 1 and login:
+            uris = login.get('uris') or [{}]
+            yield (site_from(uris[0].get('uri') or '', item.get('name', '')),
+                   login.get('username') or '',
+                   login.get('password') or '')
+
+
+def read_keepass_csv(file: TextIO, mapping: dict) -> Iterator[Record]:
+    for row in csv.DictReader(file):
+        yield (site_from(row.get('URL', row.get('Web Site', '')),
+                         row.get('Title', row.get('Account', ''))),
+               row.get('Username', row.get('Login Name', '')),
+               row.get('Password', ''))
+
+
+def read_generic_csv(file: TextIO, mapping: dict) -> Iterator[Record]:
+    for row in csv.DictReader(file):
+        yield map_record(row, mapping)
+
+
+def read_generic_json(file: TextIO, mapping: dict) -> Iterator[Record]:
+    for line in file:
+        if line.strip():
+            yield map_record(json.loads(line), mapping)
+
+
+def map_record(row: dict, mapping: dict) -> Record:
+    try:
+        return (str(row[mapping['site']]),
+                str(row[mapping['username']]),
+                str(row[mapping['password']]))
+    except KeyError as error:
+        raise ImportFileError("Missing column " + str(error))
+
+
+def stream_json_array(file: TextIO, start: re.Pattern) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    buffer = ''
+    match = None
+    while match is None:
+        chunk = file.read(JSON_READ_SIZE)
+        if not chunk:
+            raise ImportFileError("No items found in export")
+        buffer += chunk
+        match = start.search(buffer)
+    buffer, position, eof = buffer[match.end():], 0, False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if buffer[position:position + 1] == ']':
+            return None
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise ImportFileError("Malformed JSON export")
+            chunk = file.read(JSON_READ_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+
+
+READERS = {
+    ('bitwarden', 'csv'): read_bitwarden_csv,
+    ('bitwarden', 'json'): read_bitwarden_json,
+    ('keepass', 'csv'): read_keepass_csv,
+    ('generic', 'csv'): read_generic_csv,
+    ('generic', 'json'): read_generic_json,
+}
+
+
+def read_records(file: TextIO, source: str, extension: str,
+                 mapping: Optional[dict] = None) -> Iterator[Record]:
+    if (source, extension) not in READERS:
+        raise ImportFileError("Unsupported format " +
+                              source + " (" + extension + ")")
+    return READERS[source, extension](file, mapping or {})
+
+
+def import_records(records: Iterator[Record], database: storage.Backend,
+                   key: bytes,
+                   progress: Optional[Callable[[ImportStats], None]] = None
+                   ) -> ImportStats:
+    stats = ImportStats()
+    while True:
+        chunk = list(itertools.islice(records, IMPORT_CHUNK_SIZE))
+        if not chunk:
+            return stats
+        fresh = {}
+        for site, username, password in chunk:
+            pair = (site.lower().strip(" "), username.lower().strip(" "))
+            if pair[0] and pair not in fresh:
+                fresh[pair] = password
+        encrypted = enc.encrypt_passwords(
+            ((site, username, password)
+             for (site, username), password in fresh.items()), key)
+        # Entries already in the vault are skipped inside the insert's own
+        # transaction, so one added meanwhile cannot abort the import.
+        imported = database.insert_many([(site, username, password)
+                                         for (site, username), password
+                                         in zip(fresh, encrypted)],
+                                        skip_existing=True)
+        stats.imported += imported
+        stats.skipped += len(chunk) - imported
+        if progress is not None:
+            progress(stats)
+
+
+def import_file(path: str, source: str, database: storage.Backend, key: bytes,
+                mapping: Optional[dict] = None,
+                progress: Optional[Callable[[ImportStats], None]] = None
+                ) -> ImportStats:
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension == 'jsonl':
+        extension = 'json'
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        return import_records(read_records(file, source, extension, mapping),
+                              database, key, progress)
@@ -0,0 +1,178 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import profiler
+from typing import Dict, List, Optional, Tuple
+from constants import KDF_PREFIX, KDF_SALT_SIZE, KDF_DEFAULTS, \
+    KDF_MINIMUMS, KDF_CALIBRATION_RUNS, SCRYPT_MAX_MEMORY
+
+try:
+    from argon2 import low_level as argon2
+except ImportError:
+    argon2 = None
+
+ALGORITHMS = ('pbkdf2', 'scrypt', 'argon2id')
+
+
+class KdfError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class Header:
+
+    def __init__(self, algorithm: str, params: Dict[str, int],
+                 salt: bytes, verifier: bytes = b'') -> None:
+        self.algorithm = algorithm
+        self.params = params
+        self.salt = salt
+        self.verifier = verifier
+
+    def encode(self) -> bytes:
+        return b'$'.join([KDF_PREFIX, self.algorithm.encode(),
+                          format_params(self.params).encode(),
+                          encode_bytes(self.salt),
+                          encode_bytes(self.verifier)])
+
+
+def available_algorithms() -> List[str]:
+    return [x for x in ALGORITHMS if x != 'argon2id' or argon2 is not None]
+
+
+def default_algorithm() -> str:
+    return 'argon2id' if argon2 is not None else 'scrypt'
+
+
+def is_legacy(stored: bytes) -> bool:
+    return not stored.startswith(KDF_PREFIX + b'$')
+
+
+def parse_header(stored: bytes) -> Header:
+    try:
+        _, algorithm, params, salt, verifier = stored.split(b'$')
+        header = Header(algorithm.decode(),
+                        {name: int(value) for name, value in
+                         (x.split('=') for x in params.decode().split(','))},
+                        decode_bytes(salt), decode_bytes(verifier))
+    except ValueError:
+        raise KdfError("The vault header is damaged")
+    if header.algorithm not in ALGORITHMS:
+        raise KdfError("Unknown key derivation " + header.algorithm)
+    return header
+
+
+def stretch(password: str, header: Header) -> bytes:
+    params = header.params
+    with profiler.span('kdf.' + header.algorithm):
+        if header.algorithm == 'pbkdf2':
+            return hashlib.pbkdf2_hmac('sha256', password.encode(),
+                                       header.salt, params['i'], 32)
+        if header.algorithm == 'scrypt':
+            return hashlib.scrypt(password.encode(), salt=header.salt,
+                                  n=params['n'], r=params['r'],
+                                  p=params['p'], dklen=32,
+                                  maxmem=scrypt_memory(params))
+        if argon2 is None:
+            raise KdfError("This vault needs the argon2-cffi package")
+        return argon2.hash_secret_raw(password.encode(), header.salt,
+                                      time_cost=params['t'],
+                                      memory_cost=params['m'],
+                                      parallelism=params['p'], hash_len=32,
+                                      type=argon2.Type.ID)
+
+
+def split(master: bytes) -> Tuple[bytes, bytes]:
+    # One derivation yields both the encryption key and the value that
+    # proves the password, so unlocking pays for the KDF only once.
+    return (base64.urlsafe_b64encode(hmac.digest(master, b'encryption',
+                                                 'sha256')),
+            hmac.digest(master, b'verification', 'sha256'))
+
+
+def create(password: str, algorithm: Optional[str] = None,
+           params: Optional[Dict[str, int]] = None) -> Tuple[bytes, bytes]:
+    algorithm = algorithm or default_algorithm()
+    header = Header(algorithm, dict(params or KDF_DEFAULTS[algorithm]),
+                    os.urandom(KDF_SALT_SIZE))
+    key, header.verifier = split(stretch(password, header))
+    return header.encode(), key
+
+
+def unlock(password: str, stored: bytes) -> Optional[bytes]:
+    if is_legacy(stored):
+        return unlock_legacy(password, stored)
+    header = parse_header(stored)
+    key, verifier = split(stretch(password, header))
+    return key if hmac.compare_digest(verifier, header.verifier) else None
+
+
+def unlock_legacy(password: str, stored: bytes) -> Optional[bytes]:
+    import bcrypt
+    import encryption as enc
+    with profiler.span('bcrypt.checkpw'):
+        if not bcrypt.checkpw(password.encode(), stored):
+            return None
+    return enc.key_generator(password)
+
+
+def describe(stored: bytes) -> str:
+    if is_legacy(stored):
+        return 'legacy (bcrypt check, PBKDF2 100000 with a fixed salt)'
+    header = parse_header(stored)
+    return header.algorithm + ' ' + format_params(header.params)
+
+
+def calibrate(algorithm: str, target: float) -> Dict[str, int]:
+    # Cost grows about linearly with the work factor, but a run at the
+    # minimum parameters is dominated by fixed setup, so the first
+    # estimate is measured again and corrected once.
+    minimum = KDF_MINIMUMS[algorithm]
+    params = dict(minimum)
+    for _ in range(2):
+        scale = target / timing(algorithm, params)
+        if algorithm == 'pbkdf2':
+            params['i'] = max(minimum['i'],
+                              int(round(params['i'] * scale, -3)))
+        elif algorithm == 'scrypt':
+            while scale >= 1.5 and scrypt_memory(
+                    dict(params, n=params['n'] * 2)) <= SCRYPT_MAX_MEMORY:
+                params['n'] *= 2
+                scale /= 2
+            while scale < 0.75 and params['n'] > minimum['n']:
+                params['n'] //= 2
+                scale *= 2
+            params['p'] = max(1, round(params['p'] * scale))
+        else:
+            params['t'] = max(minimum['t'], round(params['t'] * scale))
+    return params
+
+
+def timing(algorithm: str, params: Dict[str, int]) -> float:
+    if algorithm not in available_algorithms():
+        raise KdfError(algorithm + " is not available")
+    header = Header(algorithm, params, os.urandom(KDF_SALT_SIZE))
+    samples = []
+    for _ in range(KDF_CALIBRATION_RUNS):
+        start = time.perf_counter()
+        stretch('calibration', header)
+        samples.append(time.perf_counter() - start)
+    return min(samples)
+
+
+def format_params(params: Dict[str, int]) -> str:
+    return ','.join(name + '=' + str(value)
+                    for name, value in sorted(params.items()))
+
+
+def scrypt_memory(params: Dict[str, int]) -> int:
+    return 128 * params['r'] * (params['n'] + params['p'] + 2) + (1 << 20)
+
+
+def encode_bytes(data: bytes) -> bytes:
+    return base64.b64encode(data).rstrip(b'=')
+
+
+def decode_bytes(data: bytes) -> bytes:
+    return base64.b64decode(data + b'=' * (-len(data) % 4))
@@ -0,0 +1,471 @@
+"""
+An append-only vault file that is read through mmap.
+
+Every change is appended as a checksummed record: an account version
+(PUT), a deletion, a new master password hash, or a CLEAR that drops
+every earlier account. Nothing is rewritten in place apart from the
+file header, which points at the latest INDEX record. An index holds
+one (site hash, id, offset) entry per live account, sorted by hash, so
+a lookup by site is a binary search over the mapped file. Opening a
+vault therefore only parses the records appended after the last index.
+
+Records that fail their checksum mark the end of the log, so a write
+torn by a crash is ignored and truncated by the next writer. Once
+enough records are appended a new index is written, and once more
+records are dead than live the file is compacted into a fresh copy
+that replaces the old one atomically.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import contextlib
+import profiler
+import storage
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from constants import LOG_VAULT_FILE, LOG_INDEX_INTERVAL, \
+    LOG_COMPACT_MIN, REKEY_CHUNK_SIZE
+
+MAGIC = b'PYPASSL1'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<IB')
+CHECKSUM = struct.Struct('<I')
+ACCOUNT = struct.Struct('<QIII')
+DELETION = struct.Struct('<Q')
+INDEX = struct.Struct('<QQQQ')
+ENTRY = struct.Struct('<QQQ')
+
+PUT, DELETE, MASTER, CLEAR, INDEXED = range(1, 6)
+
+
+class LogDatabase(storage.Backend):
+    path = LOG_VAULT_FILE
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.file = None
+        self.map = None
+        self.identity = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.size = 0
+        self.entries_start = 0
+        self.entries_count = 0
+        self.index_next_id = 1
+        self.next_id = 1
+        self.dead = 0
+        self.master = 0
+        self.cleared = False
+        self.overlay = {}
+        self.deleted = set()
+        self.tail_records = 0
+        self.cache = {}
+        self.live = None
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+        self.file, self.map, self.identity = None, None, None
+        self.reset()
+
+    def refresh(self) -> None:
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            self.close()
+            return None
+        if self.identity != (info.st_dev, info.st_ino):
+            self.load()
+        elif info.st_size != len(self.map):
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            if not self.scan(self.size, False):
+                self.load()
+
+    def load(self) -> None:
+        self.close()
+        self.file = open(self.path, 'rb')
+        info = os.fstat(self.file.fileno())
+        self.identity = (info.st_dev, info.st_ino)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size or \
+                HEADER.unpack_from(self.map)[0] != MAGIC:
+            raise storage.StorageError(self.path + " is not a pypass vault")
+        index = HEADER.unpack_from(self.map)[1]
+        start = HEADER.size
+        if index:
+            length = RECORD.unpack_from(self.map, index)[0]
+            self.entries_count, self.index_next_id, self.dead, \
+                self.master = INDEX.unpack_from(self.map,
+                                                index + RECORD.size)
+            self.entries_start = index + RECORD.size + INDEX.size
+            self.next_id = self.index_next_id
+            start = index + RECORD.size + length + CHECKSUM.size
+        self.size = start
+        with profiler.span('log.load'):
+            self.scan(start, True)
+
+    def scan(self, position: int, loading: bool) -> bool:
+        data = self.map
+        while position + RECORD.size + CHECKSUM.size <= len(data):
+            length, kind = RECORD.unpack_from(data, position)
+            end = position + RECORD.size + length + CHECKSUM.size
+            if end > len(data) or zlib.crc32(
+                    data[position + 4:end - CHECKSUM.size]) != \
+                    CHECKSUM.unpack_from(data, end - CHECKSUM.size)[0]:
+                break
+            if kind == INDEXED and not loading:
+                return False
+            self.apply(kind, position)
+            self.tail_records += 1
+            position = end
+        self.size = position
+        return True
+
+    def apply(self, kind: int, position: int) -> None:
+        self.live = None
+        if kind == PUT:
+            account = self.record(position)
+            if account.id < self.index_next_id or \
+                    account.id in self.overlay:
+                self.dead += 1
+            self.overlay[account.id] = position
+            self.next_id = max(self.next_id, account.id + 1)
+        elif kind == DELETE:
+            account_id = DELETION.unpack_from(self.map,
+                                              position + RECORD.size)[0]
+            self.overlay.pop(account_id, None)
+            self.deleted.add(account_id)
+            self.dead += 2
+        elif kind == MASTER:
+            self.dead += 1 if self.master else 0
+            self.master = position
+        elif kind == CLEAR:
+            self.dead += len(self.live_offsets()) + 1
+            self.live = None
+            self.cleared = True
+            self.overlay.clear()
+            self.deleted.clear()
+        else:
+            self.dead += 1
+
+    def record(self, position: int) -> storage.Account:
+        account = self.cache.get(position)
+        if account is None:
+            start = position + RECORD.size
+            account_id, site, username, password = \
+                ACCOUNT.unpack_from(self.map, start)
+            start += ACCOUNT.size
+            fields = []
+            for length in (site, username):
+                fields.append(self.map[start:start + length].decode())
+                start += length
+            account = storage.Account(account_id, *fields,
+                                      self.map[start:start + password])
+            self.cache[position] = account
+        return account
+
+    def entry(self, position: int) -> Tuple[int, str, str]:
+        account = self.cache.get(position)
+        if account is not None:
+            return account.id, account.site, account.username
+        account_id, site, username, _ = ACCOUNT.unpack_from(
+            self.map, position + RECORD.size)
+        start = position + RECORD.size + ACCOUNT.size
+        return (account_id, self.map[start:start + site].decode(),
+                self.map[start + site:start + site + username].decode())
+
+    def live_offsets(self) -> Dict[int, int]:
+        if self.live is None:
+            live = {}
+            if not self.cleared and self.entries_count:
+                view = memoryview(self.map)[
+                    self.entries_start:
+                    self.entries_start + self.entries_count * ENTRY.size]
+                live = {account_id: offset for _, account_id, offset
+                        in ENTRY.iter_unpack(view)}
+                view.release()
+                for account_id in self.deleted:
+                    live.pop(account_id, None)
+            live.update(self.overlay)
+            self.live = live
+        return self.live
+
+    def indexed_entries(self, key: int) -> Iterator[Tuple[int, int]]:
+        low, high = 0, self.entries_count
+        while low < high:
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self.map, self.entries_start +
+                                 middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.entries_count:
+            found, account_id, offset = ENTRY.unpack_from(
+                self.map, self.entries_start + low * ENTRY.size)
+            if found != key:
+                break
+            yield account_id, offset
+            low += 1
+
+    def create_database(self) -> None:
+        with self.writer_lock():
+            if not os.path.exists(self.path):
+                write_file(self.path, [HEADER.pack(MAGIC, 0)])
+
+    def set_password(self, password: bytes) -> None:
+        with self.writing() as records:
+            records.append(encode(MASTER, password))
+
+    def retrieve_password(self) -> bytes:
+        self.refresh()
+        if not self.master:
+            raise Exception("Master password was not saved on "
+                            "initialization. Delete " + self.path)
+        length = RECORD.unpack_from(self.map, self.master)[0]
+        start = self.master + RECORD.size
+        return self.map[start:start + length]
+
+    def insert_data(self, site: str,
+                    username: str, password: str) -> bool:
+        with self.writing() as records:
+            if self.query_site_and_user(site, username):
+                return False
+            records.append(encode_account(self.next_id, site,
+                                          username, password))
+        return True
+
+    def insert_many(self, rows: List[Tuple[str, str, str]],
+                    skip_existing: bool = False) -> int:
+        if not rows:
+            return 0
+        with self.writing() as records:
+            pairs = {(site, username) for site, username, _ in rows}
+            existing = self.query_existing_pairs(pairs)
+            if not skip_existing and (len(pairs) != len(rows) or existing):
+                raise storage.StorageError("Item already exists")
+            rows = storage.new_rows(rows, existing)
+            records.extend(encode_account(self.next_id + i, *row)
+                           for i, row in enumerate(rows))
+        return len(rows)
+
+    def query_database(self) -> list:
+        self.refresh()
+        return [self.record(offset) for _, offset
+                in sorted(self.live_offsets().items())]
+
+    def query_entries(self) -> List[storage.Entry]:
+        self.refresh()
+        return storage.project_entries(
+            self.entry(offset) for _, offset
+            in sorted(self.live_offsets().items()))
+
+    def fetch_password(self, account_id: int) -> str:
+        self.refresh()
+        offset = self.live_offsets().get(account_id) \
+            if self.map is not None else None
+        if offset is None:
+            raise storage.StorageError("Item no longer exists")
+        return self.record(offset).password
+
+    def count(self) -> int:
+        self.refresh()
+        return len(self.live_offsets()) if self.map is not None else 0
+
+    def query_site(self, site: str) -> list:
+        self.refresh()
+        if self.map is None:
+            return []
+        found = []
+        if not self.cleared:
+            for account_id, offset in self.indexed_entries(site_hash(site)):
+                if account_id not in self.overlay and \
+                        account_id not in self.deleted:
+                    found.append(self.record(offset))
+        found += [self.record(offset) for offset in self.overlay.values()]
+        return sorted((account for account in found if account.site == site),
+                      key=lambda x: x.id)
+
+    def update_item(self,
+                    site: str, username: str, new_password: str) -> None:
+        with self.writing() as records:
+            for account in self.query_site_and_user(site,
+                                                    username).get(site, []):
+                records.append(encode_account(account.id, site, username,
+                                              new_password))
+
+    def delete_row(self, site: str, username: str) -> None:
+        with self.writing() as records:
+            for account in self.query_site_and_user(site,
+                                                    username).get(site, []):
+                records.append(encode(DELETE, DELETION.pack(account.id)))
+
+    def drop_tables(self) -> None:
+        with self.writing() as records:
+            records.append(encode(CLEAR, b''))
+
+    def rebuild_index(self) -> None:
+        with self.writer_lock():
+            self.refresh()
+            self.compact()
+
+    def query_legacy_records(self, limit: int) -> list:
+        self.refresh()
+        found = []
+        if self.map is None:
+            return found
+        for _, offset in sorted(self.live_offsets().items()):
+            _, site, username, _ = ACCOUNT.unpack_from(self.map,
+                                                       offset + RECORD.size)
+            start = offset + RECORD.size + ACCOUNT.size + site + username
+            if self.map[start:start + 1] == b'g':
+                found.append(self.record(offset))
+                if len(found) == limit:
+                    break
+        return found
+
+    def update_records(self, rows: List[Tuple[int, object, bytes]]) -> int:
+        with self.writing() as records:
+            live = self.live_offsets()
+            for account_id, old, new in rows:
+                if account_id not in live:
+                    continue
+                account = self.record(live[account_id])
+                if account.password == old:
+                    records.append(encode_account(account_id, account.site,
+                                                  account.username, new))
+            return len(records)
+
+    def rekey(self, rotate: Callable[[List[tuple]], List[bytes]],
+              password_hash: bytes,
+              progress: Optional[Callable[[int], None]] = None) -> int:
+        # The re-encrypted vault is written to a separate file that
+        # replaces the old one in a single rename.
+        with self.writer_lock():
+            self.refresh()
+            return self.compact(rotate, password_hash, progress)
+
+    @contextlib.contextmanager
+    def writing(self) -> Iterator[List[bytes]]:
+        with self.writer_lock():
+            self.refresh()
+            if self.map is None:
+                raise storage.StorageError("No vault found at " + self.path)
+            records = []
+            yield records
+            if not records:
+                return None
+            with open(self.path, 'r+b') as file, \
+                    profiler.span('log.append'):
+                file.truncate(self.size)
+                file.seek(self.size)
+                file.write(b''.join(records))
+                file.flush()
+                os.fsync(file.fileno())
+            self.revision += 1
+            self.refresh()
+            if self.dead > max(LOG_COMPACT_MIN, len(self.live_offsets())):
+                self.compact()
+            elif self.tail_records >= LOG_INDEX_INTERVAL:
+                self.write_index()
+
+    def write_index(self) -> None:
+        entries = sorted((site_hash(self.record(offset).site),
+                          account_id, offset)
+                         for account_id, offset
+                         in self.live_offsets().items())
+        position = self.size
+        payload = INDEX.pack(len(entries), self.next_id, self.dead + 1,
+                             self.master) + \
+            b''.join(ENTRY.pack(*entry) for entry in entries)
+        with open(self.path, 'r+b') as file:
+            file.seek(position)
+            file.write(encode(INDEXED, payload))
+            file.flush()
+            os.fsync(file.fileno())
+            file.seek(0)
+            file.write(HEADER.pack(MAGIC, position))
+            file.flush()
+            os.fsync(file.fileno())
+        self.load()
+
+    def compact(self, rotate: Optional[Callable[[List[tuple]],
+                                                List[bytes]]] = None,
+                password_hash: Optional[bytes] = None,
+                progress: Optional[Callable[[int], None]] = None) -> int:
+        with profiler.span('log.compact'):
+            if self.map is None:
+                return 0
+            if password_hash is None and self.master:
+                password_hash = self.retrieve_password()
+            accounts = self.query_database()
+            chunks = [HEADER.pack(MAGIC, 0)]
+            position = HEADER.size
+            if password_hash is not None:
+                chunks.append(encode(MASTER, password_hash))
+                position += len(chunks[-1])
+            master = HEADER.size if password_hash is not None else 0
+            entries = []
+            for start in range(0, len(accounts), REKEY_CHUNK_SIZE):
+                chunk = accounts[start:start + REKEY_CHUNK_SIZE]
+                passwords = [account.password for account in chunk]
+                if rotate is not None:
+                    passwords = rotate([(account.site, account.username,
+                                         account.password)
+                                        for account in chunk])
+                for account, password in zip(chunk, passwords):
+                    record = encode_account(account.id, account.site,
+                                            account.username, password)
+                    entries.append((site_hash(account.site), account.id,
+                                    position))
+                    chunks.append(record)
+                    position += len(record)
+                if progress is not None:
+                    progress(start + len(chunk))
+            entries.sort()
+            chunks.append(encode(INDEXED, INDEX.pack(
+                len(entries), self.next_id, 0, master) +
+                b''.join(ENTRY.pack(*entry) for entry in entries)))
+            chunks[0] = HEADER.pack(MAGIC, position)
+            write_file(self.path, chunks)
+            self.load()
+            return len(accounts)
+
+
+def site_hash(site: str) -> int:
+    return int.from_bytes(hashlib.blake2b(site.encode(),
+                                          digest_size=8).digest(), 'little')
+
+
+def encode(kind: int, payload: bytes) -> bytes:
+    record = RECORD.pack(len(payload), kind) + payload
+    return record + CHECKSUM.pack(zlib.crc32(record[4:]))
+
+
+def encode_account(account_id: int, site: str,
+                   username: str, password: Union[str, bytes]) -> bytes:
+    fields = [site.encode(), username.encode(),
+              password.encode() if isinstance(password, str) else password]
+    return encode(PUT, ACCOUNT.pack(account_id, *map(len, fields)) +
+                  b''.join(fields))
+
+
+def write_file(path: str, chunks: List[bytes]) -> None:
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        for chunk in chunks:
+            file.write(chunk)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
@@ -1,78 +1,105 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
 import os
-import menu
-import data_manipulation as dm
-import pyperclip as clip
-import database as db
-import encryption as enc
-from typing import Optional
+import sys
+import screen
+import profiler
+from typing import Optional, TYPE_CHECKING
 from constants import ENTER, UP, DOWN, LEFT
 
+if TYPE_CHECKING:
+    import getch
+    import menu
+    import storage
+
 
 class PasswordError(Exception):
     def __init__(self, message: str) -> None:
         super().__init__(message)
 
 
+def main(args: list) -> Optional[int]:
+    args = profiler.configure(args)
+    if args[:1] == ['agent']:
+        import agent
+        return agent.main(args[1:])
+    if args:
+        import cli
+        return cli.main(args)
+    return run()
+
+
 def run() -> None:
-    database = db.Database()
+    import menu
+    import agent
+    import storage
+    import data_manipulation as dm
+    database = storage.open_backend()
 
-    os.system('clear')
+    screen.clear()
 
-    trigger = dm.create_database(database)
-    key = enc.key_generator(dm.handle_password(trigger, database))
+    key = None
+    if os.path.exists(database.path):
+        key = agent.fetch_key(agent.vault_path())
+    if key is None:
+        trigger = dm.create_database(database)
+        key = dm.handle_password(trigger, database)
+    notices = database.migrate()
+    if notices:
+        print('\n'.join(notices))
+        input("\nPress Enter to continue...")
+    import rekey
+    rekey.upgrade_records(database, key)
 
     main_menu = menu.build_main_menu()
-    menu_loop(main_menu, database, key)
+    from getch import KeyReader
+    with KeyReader() as reader:
+        menu_loop(main_menu, database, key, reader)
 
 
-def menu_loop(main_menu: menu.Menu,
-              database: db.Database, key: bytes) -> Optional[int]:
-    os.system('tput civis')
+def menu_loop(main_menu: menu.Menu, database: storage.Backend, key: bytes,
+              reader: getch.KeyReader) -> Optional[int]:
+    import menu
+    import data_manipulation as dm
+    import pyperclip as clip
+    screen.hide_cursor()
 
     while True:
-        os.system('clear')
-        main_menu.print_options()
-        user_input = get_user_input()
+        screen.draw(main_menu.option_lines())
+        user_input = reader.read_key()
         if user_input == 'k' or user_input == UP:
             main_menu.point_prev()
         elif user_input == 'j' or user_input == DOWN:
             main_menu.point_next()
         elif user_input == 'l' or user_input == ENTER:
             if isinstance(main_menu.pointer, menu.Menu):
-                menu_loop(main_menu.pointer, database, key)
+                menu_loop(main_menu.pointer, database, key, reader)
                 break
             elif isinstance(main_menu.pointer, menu.Option):
-                os.system('clear')
-                if main_menu.pointer.func == dm.show_all:
-                    main_menu.pointer.func(database, key)
-                    input("\nPress Enter to continue...")
-                elif main_menu.pointer.func.__code__.co_argcount \
-                        == 2:
-                    main_menu.pointer.func(database, key)
-                else:
-                    main_menu.pointer.func(database)
+                screen.clear()
+                with reader.cooked():
+                    func = main_menu.pointer.func
+                    if func == dm.show_all:
+                        func(database, key)
+                        input("\nPress Enter to continue...")
+                    elif func == dm.change_master_password:
+                        key = func(database, key)
+                    elif func.__code__.co_argcount == 2:
+                        func(database, key)
+                    else:
+                        func(database)
+                screen.invalidate()
         elif user_input == 'h' or user_input == LEFT:
             if main_menu.parent is not None:
-                menu_loop(main_menu.parent, database, key)
+                menu_loop(main_menu.parent, database, key, reader)
                 break
         elif user_input == 'q':
-            os.system('clear')
-            os.system('tput cnorm')
+            screen.clear()
+            screen.show_cursor()
             clip.copy('')
             return None
 
 
-def get_user_input() -> str:
-    from getch import Getch
-    getch = Getch()
-    char = getch()
-    if char == '\x1b':
-        getch()
-        return '\\' + getch()
-    return char
-
-
 if __name__ == '__main__':
-    run()
+    sys.exit(main(sys.argv[1:]))
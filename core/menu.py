@@ -38,9 +38,8 @@ class Menu(MenuObject):
             self.pointer.selected = True
         self.options.append(option)
 
-    def print_options(self) -> None:
-        for item in self.options:
-            print(item)
+    def option_lines(self) -> list:
+        return [repr(item) for item in self.options]
 
     def point_next(self) -> None:
         if self.options.index(self.pointer) + 1 == len(self.options):
@@ -67,6 +66,12 @@ def build_main_menu() -> Menu:
                          data_manip.update_data))
     base_menu.add_option(Option('Delete existing entry',
                          data_manip.delete_data))
+    base_menu.add_option(Option('Rebuild search index',
+                         data_manip.rebuild_index))
+    base_menu.add_option(Option('Audit passwords',
+                         data_manip.audit_passwords))
+    base_menu.add_option(Option('Change master password',
+                         data_manip.change_master_password))
     base_menu.add_option(Option('Reset database', data_manip.delete_all))
     return base_menu
 
@@ -83,4 +88,6 @@ def build_input_menu(base_menu: Menu) -> Menu:
     input_menu.add_option(Option('Generate password', data_manip.input_data))
     input_menu.add_option(Option('Enter existing password',
                           data_manip.input_existing_data))
+    input_menu.add_option(Option('Import from file',
+                          data_manip.import_data))
     return input_menu
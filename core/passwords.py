@@ -1,16 +1,163 @@
-import random
-from constants import UPPER, LOWER
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+from constants import UPPER, LOWER, DIGITS, SYMBOLS, LOOKALIKES, \
+    CONSONANTS, VOWELS, SYLLABLES_PER_WORD, ENTROPY_BUFFER_SIZE, \
+    DEFAULT_PASSWORD_LENGTH
 
 
-def generate_password(length: int) -> str:
-    return ''.join([determine_character_type(random.randint(0, 2))
-                   for i in range(length)])
+class PolicyError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class EntropyPool:
+
+    def __init__(self, size: int = ENTROPY_BUFFER_SIZE) -> None:
+        self.size = size
+        self.buffer = b''
+        self.offset = 0
+        self.pid = os.getpid()
+
+    def read(self, count: int) -> bytes:
+        if self.pid != os.getpid():
+            self.buffer, self.offset, self.pid = b'', 0, os.getpid()
+        if self.offset + count > len(self.buffer):
+            self.buffer = self.buffer[self.offset:] + \
+                os.urandom(max(self.size, count))
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + count]
+        self.offset += count
+        return data
+
+    def below(self, bound: int) -> int:
+        width = max(1, ((bound - 1).bit_length() + 7) // 8)
+        limit = 256 ** width - 256 ** width % bound
+        while True:
+            value = int.from_bytes(self.read(width), 'big')
+            if value < limit:
+                return value % bound
+
+    def choices(self, alphabet: str, count: int) -> str:
+        table = sampling_table(alphabet)
+        if table is None:
+            return ''.join(alphabet[self.below(len(alphabet))]
+                           for _ in range(count))
+        mapping, rejected, accepted = table
+        result = b''
+        while len(result) < count:
+            needed = count - len(result)
+            result += self.read(needed * 256 // accepted + 8).\
+                translate(mapping, rejected)
+        return result[:count].decode('ascii')
+
+    def shuffle(self, items: list) -> None:
+        for i in range(len(items) - 1, 0, -1):
+            j = self.below(i + 1)
+            items[i], items[j] = items[j], items[i]
+
+
+class Policy:
+
+    def __init__(self, length: int = DEFAULT_PASSWORD_LENGTH,
+                 lower: bool = True, upper: bool = True,
+                 digits: bool = True, symbols: bool = False,
+                 minimums: Optional[Dict[str, int]] = None,
+                 exclude_similar: bool = False, words: int = 0,
+                 separator: str = '-',
+                 wordlist: Optional[Sequence[str]] = None) -> None:
+        self.length = length
+        self.minimums = minimums or {}
+        self.words = words
+        self.separator = separator
+        self.wordlist = wordlist
+        enabled = (('lower', lower, LOWER), ('upper', upper, UPPER),
+                   ('digits', digits, DIGITS), ('symbols', symbols, SYMBOLS))
+        excluded = LOOKALIKES if exclude_similar else ''
+        self.classes = {name: ''.join(x for x in chars if x not in excluded)
+                        for name, wanted, chars in enabled if wanted}
+        self.alphabet = ''.join(self.classes.values())
+
+    def validate(self) -> None:
+        if self.words:
+            if self.words < 0:
+                raise PolicyError("Number of words must be positive")
+            if self.wordlist is not None and len(set(self.wordlist)) < 2:
+                raise PolicyError("Word list needs at least two words")
+            return None
+        if self.length < 0:
+            raise PolicyError("Password length must be positive")
+        if not self.alphabet:
+            raise PolicyError("No character classes enabled")
+        for name, count in self.minimums.items():
+            if count and name not in self.classes:
+                raise PolicyError("Minimum given for disabled class " + name)
+        if sum(self.minimums.values()) > self.length:
+            raise PolicyError("Minimums exceed the password length")
+
 
+@lru_cache(maxsize=16)
+def sampling_table(alphabet: str) -> Optional[Tuple[bytes, bytes, int]]:
+    # Bytes are mapped onto the alphabet with bytes.translate. Values at
+    # or above the largest multiple of the alphabet size are deleted
+    # rather than folded back, so every character stays equally likely.
+    if not alphabet or len(alphabet) > 256 or \
+            any(ord(x) > 127 for x in alphabet):
+        return None
+    limit = 256 - 256 % len(alphabet)
+    mapping = bytes(ord(alphabet[x % len(alphabet)]) if x < limit else 0
+                    for x in range(256))
+    return mapping, bytes(range(limit, 256)), limit
 
-def determine_character_type(value: int) -> str:
-    if value == 0:
-        return LOWER[random.SystemRandom().randint(0, 25)]
-    elif value == 1:
-        return UPPER[random.SystemRandom().randint(0, 25)]
+
+@lru_cache(maxsize=1)
+def shared_pool() -> EntropyPool:
+    return EntropyPool()
+
+
+def generate(policy: Policy, pool: Optional[EntropyPool] = None) -> str:
+    policy.validate()
+    pool = pool or shared_pool()
+    if policy.words:
+        return build_passphrase(policy, pool)
+    return build_password(policy, pool)
+
+
+def generate_many(count: int, policy: Optional[Policy] = None,
+                  pool: Optional[EntropyPool] = None) -> List[str]:
+    policy = policy or Policy()
+    policy.validate()
+    pool = pool or shared_pool()
+    if policy.words or any(policy.minimums.values()):
+        return [generate(policy, pool) for _ in range(count)]
+    length = policy.length
+    text = pool.choices(policy.alphabet, count * length)
+    return [text[i:i + length] for i in range(0, count * length, length)]
+
+
+def build_password(policy: Policy, pool: EntropyPool) -> str:
+    required = ''.join(pool.choices(policy.classes[name], count)
+                       for name, count in policy.minimums.items() if count)
+    password = required + pool.choices(policy.alphabet,
+                                       policy.length - len(required))
+    if not required:
+        return password
+    characters = list(password)
+    pool.shuffle(characters)
+    return ''.join(characters)
+
+
+def build_passphrase(policy: Policy, pool: EntropyPool) -> str:
+    if policy.wordlist is not None:
+        words = [policy.wordlist[pool.below(len(policy.wordlist))]
+                 for _ in range(policy.words)]
     else:
-        return str(random.SystemRandom().randint(0, 9))
+        words = [''.join(x + y for x, y in zip(
+            pool.choices(CONSONANTS, SYLLABLES_PER_WORD),
+            pool.choices(VOWELS, SYLLABLES_PER_WORD)))
+            for _ in range(policy.words)]
+    return policy.separator.join(words)
+
+
+def generate_password(length: int) -> str:
+    return generate(Policy(length))
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import atexit
+import threading
+from typing import Dict, List, Optional
+from constants import PROFILE_FLAG, TRACE_FILE, PROFILE_PERCENTILES
+
+
+class NullSpan:
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        return None
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ('recorder', 'name', 'args', 'start')
+
+    def __init__(self, recorder: 'Recorder', name: str,
+                 args: Optional[dict]) -> None:
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, error: Optional[type], *args) -> None:
+        # Spans left through an exception are kept apart, so that a
+        # cancelled search does not pass for a fast one.
+        name = self.name if error is None else \
+            self.name + ' (' + error.__name__ + ')'
+        self.recorder.add_span(name, self.start,
+                               time.perf_counter_ns() - self.start,
+                               self.args)
+
+
+class Recorder:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.origin = time.perf_counter_ns()
+        self.spans = []
+        self.samples = []
+        self.counters = {}
+        self.threads = {}
+
+    def add_span(self, name: str, start: int, duration: int,
+                 args: Optional[dict]) -> None:
+        thread = threading.get_ident()
+        if thread not in self.threads:
+            self.threads[thread] = threading.current_thread().name
+        self.spans.append((name, start, duration, thread, args))
+
+    def count(self, name: str, amount: int) -> None:
+        total = self.counters.get(name, 0) + amount
+        self.counters[name] = total
+        self.samples.append((name, time.perf_counter_ns(), total))
+
+    def durations(self) -> Dict[str, List[int]]:
+        found = {}
+        for name, _, duration, _, _ in self.spans:
+            found.setdefault(name, []).append(duration)
+        return found
+
+    def trace_events(self) -> List[dict]:
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                   'tid': thread, 'args': {'name': name}}
+                  for thread, name in self.threads.items()]
+        for name, start, duration, thread, args in self.spans:
+            event = {'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                     'ts': (start - self.origin) / 1000,
+                     'dur': duration / 1000, 'pid': pid, 'tid': thread}
+            if args:
+                event['args'] = args
+            events.append(event)
+        events += [{'name': name, 'ph': 'C',
+                    'ts': (stamp - self.origin) / 1000, 'pid': pid,
+                    'args': {name: total}}
+                   for name, stamp, total in self.samples]
+        return events
+
+    def summary_lines(self) -> List[str]:
+        header = '{:<36}{:>8}{:>12}'.format('span', 'count', 'total ms') + \
+            ''.join('{:>10}'.format('p%d ms' % x)
+                    for x in PROFILE_PERCENTILES) + '{:>10}'.format('max ms')
+        lines = [header, '-' * len(header)]
+        durations = self.durations()
+        for name in sorted(durations, key=lambda x: -sum(durations[x])):
+            samples = sorted(durations[name])
+            lines.append('{:<36}{:>8}{:>12.2f}'.format(
+                name, len(samples), sum(samples) / 1e6) +
+                ''.join('{:>10.3f}'.format(percentile(samples, x) / 1e6)
+                        for x in PROFILE_PERCENTILES) +
+                '{:>10.3f}'.format(samples[-1] / 1e6))
+        if self.counters:
+            lines += ['', '{:<36}{:>12}'.format('counter', 'total')]
+            lines += ['{:<36}{:>12}'.format(name, total)
+                      for name, total in sorted(self.counters.items())]
+        return lines
+
+    def write(self) -> None:
+        import json
+        with open(self.path, 'w') as file:
+            json.dump({'traceEvents': self.trace_events(),
+                       'displayTimeUnit': 'ms'}, file)
+        with open(os.path.splitext(self.path)[0] + '.txt', 'w') as file:
+            file.write('\n'.join(self.summary_lines()) + '\n')
+
+
+recorder = None
+
+
+def span(name: str, args: Optional[dict] = None) -> object:
+    if recorder is None:
+        return NULL_SPAN
+    return Span(recorder, name, args)
+
+
+def count(name: str, amount: int = 1) -> None:
+    if recorder is not None:
+        recorder.count(name, amount)
+
+
+def enable(path: Optional[str] = None) -> Recorder:
+    global recorder
+    if recorder is None:
+        recorder = Recorder(path or TRACE_FILE % os.getpid())
+        atexit.register(finish)
+    return recorder
+
+
+def finish() -> None:
+    global recorder
+    if recorder is None:
+        return None
+    done, recorder = recorder, None
+    try:
+        done.write()
+    except OSError as error:
+        print("[Error]: Could not write trace: " + str(error),
+              file=sys.stderr)
+        return None
+    print('\n'.join(done.summary_lines()), file=sys.stderr)
+    print("Trace written to " + done.path, file=sys.stderr)
+
+
+def configure(args: List[str]) -> List[str]:
+    # The flag is only recognised in front of the command, so it can
+    # never be mistaken for a site or username.
+    if args[:1] == [PROFILE_FLAG]:
+        enable()
+        return args[1:]
+    if args[:1] and args[0].startswith(PROFILE_FLAG + '='):
+        enable(args[0][len(PROFILE_FLAG) + 1:])
+        return args[1:]
+    return args
+
+
+def percentile(samples: List[int], rank: float) -> int:
+    position = max(0, -(-len(samples) * rank // 100) - 1)
+    return samples[min(len(samples) - 1, int(position))]
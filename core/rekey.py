@@ -0,0 +1,63 @@
+import agent
+import kdf
+import encryption as enc
+import storage
+from cryptography import fernet
+from typing import Callable, Dict, Optional
+from constants import RECORD_UPGRADE_BATCH, RECORD_UPGRADE_LIMIT
+
+
+class RekeyError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+def change_master_password(database: storage.Backend, old_password: str,
+                           new_password: str,
+                           progress: Optional[Callable[[int], None]] = None,
+                           algorithm: Optional[str] = None,
+                           params: Optional[Dict[str, int]] = None) -> bytes:
+    stored = database.retrieve_password()
+    try:
+        old_key = kdf.unlock(old_password, stored)
+    except kdf.KdfError as error:
+        raise RekeyError(str(error))
+    if old_key is None:
+        raise RekeyError("Incorrect password")
+    if algorithm is None and not kdf.is_legacy(stored):
+        current = kdf.parse_header(stored)
+        algorithm, params = current.algorithm, params or current.params
+    header, new_key = kdf.create(new_password, algorithm, params)
+    try:
+        with enc.KeyRotation(old_key, new_key) as rotation:
+            database.rekey(rotation.rotate, header, progress)
+    except fernet.InvalidToken:
+        raise RekeyError("An entry could not be decrypted with the current "
+                         "key. Nothing was changed")
+    vault = agent.vault_path()
+    if agent.fetch_key(vault) is not None:
+        agent.request({'cmd': 'put', 'vault': vault, 'key': new_key.decode()})
+    return new_key
+
+
+def upgrade_records(database: storage.Backend, key: bytes,
+                    limit: int = RECORD_UPGRADE_LIMIT) -> int:
+    # Entries still holding Fernet tokens are rewritten a batch at a time,
+    # each batch in its own transaction. A row is only replaced if it
+    # still holds the token that was read, so concurrent edits win.
+    done = 0
+    while done < limit:
+        accounts = database.query_legacy_records(
+            min(RECORD_UPGRADE_BATCH, limit - done))
+        if not accounts:
+            break
+        try:
+            tokens = enc.rotate_chunk([(x.site, x.username, x.password)
+                                       for x in accounts], key, key)
+        except fernet.InvalidToken:
+            break
+        database.update_records([(account.id, account.password, token)
+                                 for account, token
+                                 in zip(accounts, tokens)])
+        done += len(accounts)
+    return done
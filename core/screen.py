@@ -0,0 +1,83 @@
+import sys
+import shutil
+import profiler
+from typing import List, Optional, TextIO
+
+CLEAR = '\x1b[H\x1b[2J\x1b[3J'
+HIDE_CURSOR = '\x1b[?25l'
+SHOW_CURSOR = '\x1b[?25h'
+CLEAR_LINE = '\x1b[K'
+CLEAR_BELOW = '\x1b[J'
+
+
+class Screen:
+
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        self.stream = stream
+        self.frame = None
+
+    def write(self, text: str) -> None:
+        stream = self.stream or sys.stdout
+        stream.write(text)
+        stream.flush()
+
+    def clear(self) -> None:
+        self.frame = None
+        self.write(CLEAR)
+
+    def invalidate(self) -> None:
+        self.frame = None
+
+    def hide_cursor(self) -> None:
+        self.write(HIDE_CURSOR)
+
+    def show_cursor(self) -> None:
+        self.write(SHOW_CURSOR)
+
+    def draw(self, lines: List[str]) -> None:
+        with profiler.span('screen.draw'):
+            self.render(lines)
+
+    def render(self, lines: List[str]) -> None:
+        width, height = shutil.get_terminal_size()
+        lines = [line[:width] for text in lines
+                 for line in text.split('\n')][:height]
+        output = []
+        previous = self.frame
+        if previous is None:
+            output.append(CLEAR)
+            previous = []
+        for row, line in enumerate(lines):
+            if row >= len(previous) or previous[row] != line:
+                output.append('\x1b[' + str(row + 1) + ';1H' +
+                              line + CLEAR_LINE)
+        if len(lines) < len(previous):
+            output.append('\x1b[' + str(len(lines) + 1) + ';1H' +
+                          CLEAR_BELOW)
+        self.frame = lines
+        output = ''.join(output)
+        profiler.count('screen.bytes', len(output))
+        self.write(output)
+
+
+screen = Screen()
+
+
+def clear() -> None:
+    screen.clear()
+
+
+def hide_cursor() -> None:
+    screen.hide_cursor()
+
+
+def show_cursor() -> None:
+    screen.show_cursor()
+
+
+def draw(lines: List[str]) -> None:
+    screen.draw(lines)
+
+
+def invalidate() -> None:
+    screen.invalidate()
@@ -33,11 +33,37 @@ a detection should occur.
 
 For example, given "books" and "www.ourbookstore.com", the
 algorithm checks if "books" and "ooks" are in the target.
+
+Rather than filling a fresh matrix for every window of the target,
+is_found uses Myers' bit-parallel formulation of the same recurrence.
+Each column of the matrix is encoded as two bit vectors of vertical
++1/-1 deltas, so a whole column is computed with a handful of integer
+operations. A single Sellers-style pass (the first row fixed at zero,
+so a match may begin anywhere) reports the positions in the target
+where some substring ending there is within the allowed errors. Only
+the windows ending at those positions are then checked against the
+anchored distance, stopping as soon as the remaining columns can no
+longer bring the distance under the cutoff. Exact occurrences and
+targets where the first character of the query is rare are settled
+with str.find before any bit vectors are built.
+
+Matches can also be scored for ranking: fewer errors, fewer skipped
+leading query characters and earlier matches score higher, with
+bonuses for matching at the start of the target or of a word.
 """
 
-from typing import List
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
 from constants import SENSITIVITY
 
+SCORE_BASE = 100
+ERROR_PENALTY = 10
+SKIP_PENALTY = 5
+MAX_POSITION_PENALTY = 20
+PREFIX_BONUS = 15
+BOUNDARY_BONUS = 10
+WORD_SEPARATORS = './-_@ '
+
 
 def edit_distance(source: str, target: str) -> int:
     len_source, len_target = len(source), len(target)
@@ -72,12 +98,143 @@ def calculate_diagonal(row: int, col: int, matrix: List[list],
                                matrix[i - 1][j - 1] + cost)
 
 
-def is_found(source: str, target: str) -> bool:
-    for i in range(len(target)):
-        if source[0] == target[i] and len(target) - 1 - i >= len(source) - 1:
-            snippet = target[i:i + len(source)]
-            if edit_distance(source, snippet) <= len(source) // 2:
+class Matcher:
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.levels = [(pattern, build_peq(pattern), len(pattern) // 2)
+                       for pattern in suffix_levels(source)]
+
+    def matches(self, target: str) -> bool:
+        for pattern, peq, max_errors in self.levels:
+            length = len(pattern)
+            last_start = len(target) - length
+            if last_start < 0:
+                continue
+            if pattern in target:
                 return True
-    if len(source) - 1 > SENSITIVITY:
-        return is_found(source[1:], target)
-    return False
+            start = target.find(pattern[0], 0, last_start + 1)
+            if start == -1:
+                continue
+            if target.count(pattern[0], start, last_start + 1) * length \
+                    <= len(target):
+                while start != -1:
+                    if window_distance(peq, length, max_errors,
+                                       target, start) <= max_errors:
+                        return True
+                    start = target.find(pattern[0], start + 1,
+                                        last_start + 1)
+                continue
+            for end in search_ends(peq, length, max_errors, target):
+                start = end - length + 1
+                if start >= 0 and target[start] == pattern[0] and \
+                        window_distance(peq, length, max_errors,
+                                        target, start) <= max_errors:
+                    return True
+        return False
+
+    def score(self, target: str) -> Optional[int]:
+        best = None
+        for depth, (pattern, peq, max_errors) in enumerate(self.levels):
+            length = len(pattern)
+            last_start = len(target) - length
+            if last_start < 0:
+                continue
+            start = target.find(pattern[0], 0, last_start + 1)
+            while start != -1:
+                errors = window_distance(peq, length, max_errors,
+                                         target, start)
+                if errors <= max_errors:
+                    value = rank_value(errors, depth, start, target)
+                    if best is None or value > best:
+                        best = value
+                start = target.find(pattern[0], start + 1, last_start + 1)
+        return best
+
+
+def rank_value(errors: int, depth: int, start: int, target: str) -> int:
+    value = SCORE_BASE - ERROR_PENALTY * errors - SKIP_PENALTY * depth - \
+        min(start, MAX_POSITION_PENALTY)
+    if start == 0:
+        value += PREFIX_BONUS
+    elif target[start - 1] in WORD_SEPARATORS:
+        value += BOUNDARY_BONUS
+    return value
+
+
+def suffix_levels(source: str) -> List[str]:
+    if not source:
+        return []
+    return [source[i:] for i in range(max(1, len(source) - SENSITIVITY))]
+
+
+def build_peq(pattern: str) -> Dict[str, int]:
+    peq = {}
+    for i, char in enumerate(pattern):
+        peq[char] = peq.get(char, 0) | (1 << i)
+    return peq
+
+
+def search_ends(peq: Dict[str, int], length: int,
+                max_errors: int, target: str) -> Iterator[int]:
+    mask = (1 << length) - 1
+    high = 1 << (length - 1)
+    pv, mv, score = mask, 0, length
+    for j, char in enumerate(target):
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        if score <= max_errors:
+            yield j
+
+
+def window_distance(peq: Dict[str, int], length: int, max_errors: int,
+                    target: str, start: int) -> int:
+    mask = (1 << length) - 1
+    high = 1 << (length - 1)
+    pv, mv, score = mask, 0, length
+    for j in range(length):
+        eq = peq.get(target[start + j], 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        if score - (length - j - 1) > max_errors:
+            return max_errors + 1
+    return score
+
+
+@lru_cache(maxsize=64)
+def compile_query(source: str) -> Matcher:
+    return Matcher(source)
+
+
+def is_found(source: str, target: str) -> bool:
+    return compile_query(source).matches(target)
+
+
+def refines(source: str) -> bool:
+    # Dropping the last character from both a query and a window never
+    # raises their distance, so a longer query only matches a subset of
+    # the targets the shorter one did while it is compared in a single
+    # pass and the extra character does not raise the error allowance.
+    return len(source) < 2 or \
+        (len(source) % 2 == 0 and len(source) <= SENSITIVITY)
@@ -0,0 +1,290 @@
+import os
+import abc
+import time
+import hashlib
+import itertools
+import contextlib
+import profiler
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, \
+    Tuple, Union, TYPE_CHECKING
+from constants import DATABASE_FILE, LOG_VAULT_FILE, BACKEND_VARIABLE, \
+    SYNC_BUCKET_BITS, SYNC_DIGEST_BITS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if TYPE_CHECKING:
+    import vector_search
+
+BACKENDS = {'sqlite': DATABASE_FILE, 'log': LOG_VAULT_FILE}
+
+
+class StorageError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class Account:
+
+    def __init__(self, id: int, site: str,
+                 username: str, password: str) -> None:
+        self.id = id
+        self.site = site
+        self.username = username
+        self.password = password
+
+
+class Entry(NamedTuple):
+    id: int
+    site: str
+    username: str
+
+
+class SyncRow(NamedTuple):
+    site: str
+    username: str
+    version: int
+    modified: int
+    digest: int
+    # None marks a tombstone left by a deletion.
+    password: Optional[Union[str, bytes]]
+
+
+class Backend(abc.ABC):
+    path = DATABASE_FILE
+
+    def __init__(self) -> None:
+        self.revision = 0
+        self.vectors = None
+
+    @abc.abstractmethod
+    def create_database(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def set_password(self, password: bytes) -> None:
+        ...
+
+    @abc.abstractmethod
+    def retrieve_password(self) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def insert_data(self, site: str,
+                    username: str, password: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def query_database(self) -> list:
+        ...
+
+    @abc.abstractmethod
+    def query_site(self, site: str) -> list:
+        ...
+
+    @abc.abstractmethod
+    def update_item(self,
+                    site: str, username: str, new_password: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete_row(self, site: str, username: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def drop_tables(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def rekey(self, rotate: Callable[[List[tuple]], List[bytes]],
+              password_hash: bytes,
+              progress: Optional[Callable[[int], None]] = None) -> int:
+        ...
+
+    @abc.abstractmethod
+    def query_legacy_records(self, limit: int) -> list:
+        ...
+
+    @abc.abstractmethod
+    def update_records(self, rows: List[Tuple[int, object, bytes]]) -> int:
+        ...
+
+    def sync_leaves(self) -> Dict[int, Tuple[int, int]]:
+        raise StorageError("Only sqlite vaults keep the row versions "
+                           "needed to sync")
+
+    def sync_rows(self, buckets: List[int]) -> List[SyncRow]:
+        raise StorageError("Only sqlite vaults keep the row versions "
+                           "needed to sync")
+
+    def apply_sync(self, rows: List[SyncRow]) -> None:
+        raise StorageError("Only sqlite vaults keep the row versions "
+                           "needed to sync")
+
+    def migrate(self) -> List[str]:
+        return []
+
+    def rebuild_index(self) -> None:
+        return None
+
+    def close(self) -> None:
+        return None
+
+    def insert_many(self, rows: List[Tuple[str, str, str]],
+                    skip_existing: bool = False) -> int:
+        inserted = 0
+        for site, username, password in rows:
+            if self.insert_data(site, username, password):
+                inserted += 1
+            elif not skip_existing:
+                raise StorageError("Item already exists: " + site)
+        return inserted
+
+    def query_entries(self) -> List[Entry]:
+        return [Entry(account.id, account.site, account.username)
+                for account in self.query_database()]
+
+    def fetch_password(self, account_id: int) -> str:
+        for account in self.query_database():
+            if account.id == account_id:
+                return account.password
+        raise StorageError("Item no longer exists")
+
+    def count(self) -> int:
+        return len(self.query_entries())
+
+    def query_existing_pairs(self, pairs: set) -> set:
+        return {(account.site, account.username)
+                for site in {site for site, _ in pairs}
+                for account in self.query_site(site)} & pairs
+
+    def query_site_and_user(self, site: str, username: str) -> dict:
+        accounts = [account for account in self.query_site(site)
+                    if account.username == username]
+        return {site: accounts} if accounts else {}
+
+    def query_all_entries(self, passwords: bool = True) \
+            -> Iterator[Tuple[str, list]]:
+        accounts = sorted(self.query_database() if passwords
+                          else self.query_entries(),
+                          key=lambda x: (x.site, x.id))
+        for site, group in itertools.groupby(accounts, lambda x: x.site):
+            yield site, list(group)
+
+    def is_empty(self) -> bool:
+        return not self.count()
+
+    def files(self) -> List[str]:
+        return [self.path]
+
+    def data_version(self) -> tuple:
+        # Commits from other processes are noticed through the size and
+        # modification time of the files backing the vault.
+        state = [self.revision]
+        for path in self.files():
+            try:
+                info = os.stat(path)
+                state.append((info.st_mtime_ns, info.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def search_index(self) -> 'vector_search.VectorIndex':
+        import vector_search
+        version = self.data_version()
+        if self.vectors is None or self.vectors.revision != version:
+            with profiler.span('search.index'):
+                self.vectors = vector_search.VectorIndex(
+                    self.query_entries(), version)
+        return self.vectors
+
+    @contextlib.contextmanager
+    def writer_lock(self) -> Iterator[None]:
+        if fcntl is None:
+            yield None
+            return None
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield None
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def backend_name() -> str:
+    name = os.environ.get(BACKEND_VARIABLE)
+    if name:
+        if name not in BACKENDS:
+            raise StorageError("Unknown storage backend " + name)
+        return name
+    for name, path in BACKENDS.items():
+        if os.path.exists(path):
+            return name
+    return 'sqlite'
+
+
+def vault_file(name: Optional[str] = None) -> str:
+    return BACKENDS[name or backend_name()]
+
+
+def open_backend(name: Optional[str] = None) -> Backend:
+    if (name or backend_name()) == 'log':
+        import logstore
+        return logstore.LogDatabase()
+    import database
+    return database.Database()
+
+
+def project_entries(rows: Iterator[tuple]) -> List[Entry]:
+    # Sites and usernames repeat across a vault, so equal strings are
+    # shared between records instead of kept once per row.
+    strings = {}
+    return [Entry(account_id, strings.setdefault(site, site),
+                  strings.setdefault(username, username))
+            for account_id, site, username in rows]
+
+
+def new_rows(rows: List[Tuple[str, str, str]],
+             existing: set) -> List[Tuple[str, str, str]]:
+    # Keeps the first row of every entry that is not stored yet, so a
+    # batch repeating an entry adds it once on every backend.
+    seen, kept = set(existing), []
+    for row in rows:
+        if row[:2] not in seen:
+            seen.add(row[:2])
+            kept.append(row)
+    return kept
+
+
+def row_bucket(site: str, username: str) -> int:
+    # Buckets depend on the entry alone, so an entry falls in the same
+    # bucket of every vault whatever its version.
+    digest = hashlib.blake2b(site.encode() + b'\0' + username.encode(),
+                             digest_size=4).digest()
+    return int.from_bytes(digest, 'little') >> (32 - SYNC_BUCKET_BITS)
+
+
+def row_digest(*fields: object) -> int:
+    data = b'\0'.join(x if isinstance(x, bytes) else str(x).encode()
+                      for x in fields)
+    return int.from_bytes(hashlib.blake2b(
+        data, digest_size=SYNC_DIGEST_BITS // 8).digest(), 'little')
+
+
+def stamp(site: str, username: str, version: int,
+          deleted: bool = False) -> dict:
+    modified = time.time_ns()
+    return {'version': version, 'modified': modified,
+            'bucket': row_bucket(site, username),
+            'digest': row_digest(site, username, version, modified,
+                                 'deleted' if deleted else 'live')}
+
+
+def copy_vault(source: Backend, target: Backend) -> int:
+    target.set_password(source.retrieve_password())
+    rows = [(account.site, account.username, account.password)
+            for account in source.query_database()]
+    target.insert_many(rows)
+    return len(rows)
@@ -0,0 +1,176 @@
+import os
+import time
+import hashlib
+import profiler
+import storage
+from typing import Callable, Dict, List, Optional, Tuple
+from constants import SYNC_BUCKET_BITS, SYNC_FANOUT
+
+Resolver = Callable[[storage.SyncRow, storage.SyncRow], storage.SyncRow]
+
+
+class SyncError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class MerkleTree:
+
+    def __init__(self, leaves: Dict[int, Tuple[int, int]]) -> None:
+        level = [node_hash(b'%d:%d' % leaves.get(bucket, (0, 0)))
+                 for bucket in range(1 << SYNC_BUCKET_BITS)]
+        self.levels = [level]
+        while len(level) > 1:
+            level = [node_hash(b''.join(level[i:i + SYNC_FANOUT]))
+                     for i in range(0, len(level), SYNC_FANOUT)]
+            self.levels.append(level)
+
+    @property
+    def root(self) -> bytes:
+        return self.levels[-1][0]
+
+    def diff(self, other: 'MerkleTree') -> List[int]:
+        # Walking down from the root only opens the children of nodes
+        # that differ, so a few changes cost a few paths through the tree.
+        nodes = [0] if self.root != other.root else []
+        for depth in range(len(self.levels) - 2, -1, -1):
+            mine, theirs = self.levels[depth], other.levels[depth]
+            nodes = [child for node in nodes
+                     for child in range(node * SYNC_FANOUT,
+                                        min(len(mine),
+                                            (node + 1) * SYNC_FANOUT))
+                     if mine[child] != theirs[child]]
+        return nodes
+
+
+class SyncReport:
+
+    def __init__(self) -> None:
+        self.buckets = 0
+        self.rows = 0
+        self.pulled = []
+        self.pushed = []
+        self.conflicts = 0
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+
+def node_hash(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def open_vault(path: str) -> Tuple[storage.Backend, List[str]]:
+    import database
+    import sqlalchemy as sql
+    if not os.path.isfile(path):
+        raise SyncError("No vault found at " + path)
+    vault = database.Database(path)
+    try:
+        notices = vault.migrate()
+    except sql.exc.DatabaseError:
+        vault.close()
+        raise SyncError(path + " is not a sqlite vault")
+    return vault, notices
+
+
+def newest(local: storage.SyncRow,
+           remote: storage.SyncRow) -> storage.SyncRow:
+    return max(local, remote, key=lambda x: (x.modified, x.version, x.digest))
+
+
+def same_password(local: storage.SyncRow, remote: storage.SyncRow,
+                  local_key: bytes, remote_key: bytes) -> bool:
+    import encryption as enc
+    if local.password is None or remote.password is None:
+        return local.password is None and remote.password is None
+    return enc.decrypt_password(local.password, local_key,
+                                local.site, local.username) == \
+        enc.decrypt_password(remote.password, remote_key,
+                             remote.site, remote.username)
+
+
+def transfer(rows: List[storage.SyncRow], source_key: bytes,
+             target_key: bytes) -> List[storage.SyncRow]:
+    # Vaults sharing a master password header share the key, and their
+    # records are copied as they are. Otherwise they are re-encrypted.
+    if source_key == target_key:
+        return rows
+    import encryption as enc
+    live = [row for row in rows if row.password is not None]
+    tokens = enc.rotate_chunk([(x.site, x.username, x.password)
+                               for x in live], source_key, target_key)
+    moved = {(row.site, row.username): row._replace(password=token)
+             for row, token in zip(live, tokens)}
+    return [moved.get((row.site, row.username), row) for row in rows]
+
+
+def merge(local: storage.Backend, remote: storage.Backend,
+          local_key: bytes, remote_key: bytes,
+          resolve: Optional[Resolver] = None,
+          dry_run: bool = False) -> SyncReport:
+    report = SyncReport()
+    with profiler.span('sync.tree'):
+        buckets = MerkleTree(local.sync_leaves()).diff(
+            MerkleTree(remote.sync_leaves()))
+    report.buckets = len(buckets)
+    if buckets:
+        with profiler.span('sync.rows'):
+            mine = {(x.site, x.username): x
+                    for x in local.sync_rows(buckets)}
+            theirs = {(x.site, x.username): x
+                      for x in remote.sync_rows(buckets)}
+        report.rows = len(mine) + len(theirs)
+        for pair in sorted(mine.keys() | theirs.keys()):
+            ours, other = mine.get(pair), theirs.get(pair)
+            if ours is None:
+                report.pulled.append(other)
+            elif other is None:
+                report.pushed.append(ours)
+            elif ours.digest != other.digest:
+                # Without a common ancestor an edit on one side cannot be
+                # told from edits on both, so every differing revision is
+                # settled here. Equal passwords, as in copies fingerprinted
+                # before versioning, are never worth asking about.
+                report.conflicts += 1
+                winner = newest(ours, other)
+                if resolve is not None and not same_password(
+                        ours, other, local_key, remote_key):
+                    winner = resolve(ours, other)
+                (report.pulled if winner is other
+                 else report.pushed).append(winner)
+    if not dry_run:
+        with profiler.span('sync.apply'):
+            if report.pulled:
+                local.apply_sync(transfer(report.pulled, remote_key,
+                                          local_key))
+            if report.pushed:
+                remote.apply_sync(transfer(report.pushed, local_key,
+                                           remote_key))
+    report.elapsed = time.perf_counter() - report.start
+    return report
+
+
+def describe_row(row: storage.SyncRow) -> str:
+    state = 'deleted' if row.password is None else 'changed'
+    when = time.strftime('%Y-%m-%d %H:%M:%S',
+                         time.localtime(row.modified / 1e9)) \
+        if row.modified else 'before versioning'
+    return state + ' ' + when + ', version ' + str(row.version)
+
+
+def report_lines(report: SyncReport, dry_run: bool) -> List[str]:
+    if not report.buckets:
+        return ['The vaults are already in sync']
+    verb = 'Would take' if dry_run else 'Took'
+    lines = ['Compared ' + str(report.rows) + ' entries in ' +
+             str(report.buckets) + ' differing buckets in ' +
+             '%.2f' % report.elapsed + 's']
+    for label, rows in (('from the other vault', report.pulled),
+                        ('into the other vault', report.pushed)):
+        lines.append(verb + ' ' + str(len(rows)) + ' entries ' + label)
+        lines += ['    ' + row.site + '  ' + row.username + '  (' +
+                  describe_row(row) + ')' for row in rows]
+    if report.conflicts:
+        lines.append(str(report.conflicts) + ' of them replaced a different '
+                     'version of the entry')
+    return lines
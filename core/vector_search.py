@@ -0,0 +1,82 @@
+import search
+from typing import List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AVAILABLE = np is not None
+FIELDS = ('site', 'username')
+
+
+class VectorIndex:
+
+    def __init__(self, accounts: list, revision: tuple = ()) -> None:
+        self.accounts = sorted(accounts, key=lambda x: x.id)
+        self.ids = [account.id for account in self.accounts]
+        self.revision = revision
+        self.texts = [[getattr(account, field) for account in self.accounts]
+                      for field in FIELDS]
+        self.fields = [encode_texts(texts) for texts in self.texts] \
+            if AVAILABLE else None
+
+    def match(self, search_input: str) -> List[int]:
+        if not search_input:
+            return list(self.ids)
+        if self.fields is None:
+            matcher = search.compile_query(search_input)
+            return [self.ids[i] for i in range(len(self.ids))
+                    if any(matcher.matches(texts[i]) for texts in self.texts)]
+        found = np.zeros(len(self.ids), dtype=bool)
+        for pattern in search.suffix_levels(search_input):
+            for codes, lengths in self.fields:
+                rows = np.flatnonzero(~found)
+                found[rows[match_rows(pattern, codes[rows],
+                                      lengths[rows])]] = True
+        return [self.ids[i] for i in np.flatnonzero(found)]
+
+    def search(self, search_input: str) -> list:
+        positions = {account_id: i for i, account_id in enumerate(self.ids)}
+        return [self.accounts[positions[account_id]]
+                for account_id in self.match(search_input)]
+
+
+def encode_texts(texts: List[str]) -> tuple:
+    lengths = np.array([len(text) for text in texts], dtype=np.int32)
+    width = max(1, int(lengths.max())) if len(texts) else 1
+    codes = np.full((len(texts), width), -1, dtype=np.int32)
+    codes[np.arange(width) < lengths[:, None]] = np.frombuffer(
+        ''.join(texts).encode('utf-32-le'), dtype='<u4')
+    return codes, lengths
+
+
+def match_rows(pattern: str, codes: 'np.ndarray',
+               lengths: 'np.ndarray') -> 'np.ndarray':
+    # Every window that starts with the first query character is laid out
+    # as one row of a matrix, and the edit distance table is filled one
+    # query character at a time for all of them together. Within a table
+    # row the left-neighbour term is a running minimum, so each step is a
+    # cumulative minimum instead of a Python loop over the window.
+    length, max_errors = len(pattern), len(pattern) // 2
+    starts = codes.shape[1] - length + 1
+    if starts <= 0 or not len(codes):
+        return np.zeros(0, dtype=np.intp)
+    offsets = np.arange(starts)
+    candidates = (codes[:, :starts] == ord(pattern[0])) & \
+        (offsets <= (lengths - length)[:, None])
+    rows, begins = np.nonzero(candidates)
+    windows = codes[rows[:, None], begins[:, None] + np.arange(length)]
+    steps = np.arange(1, length + 1, dtype=np.int32)
+    previous = np.broadcast_to(np.arange(length + 1, dtype=np.int32),
+                               (len(rows), length + 1))
+    for i, char in enumerate(pattern, 1):
+        diagonal = np.minimum(previous[:, :-1] + (windows != ord(char)),
+                              previous[:, 1:] + 1)
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        current[:, 1:] = steps + np.minimum.accumulate(
+            np.minimum(diagonal - steps, i), axis=1)
+        keep = current.min(axis=1) <= max_errors
+        rows, windows, previous = rows[keep], windows[keep], current[keep]
+    return np.unique(rows[previous[:, length] <= max_errors])
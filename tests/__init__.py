@@ -0,0 +1,7 @@
+import os
+import sys
+
+CORE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'core')
+if CORE not in sys.path:
+    sys.path.insert(0, CORE)
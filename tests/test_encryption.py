@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+import database
+import logstore
+import rekey
+import encryption as enc
+from cryptography import fernet
+from constants import DATABASE_FILE, LOG_VAULT_FILE, RECORD_KEY_VERSION
+
+
+class RecordTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.key = fernet.Fernet.generate_key()
+
+    def test_round_trip(self) -> None:
+        token = enc.encrypt_password('hunter2', self.key, 'a.com', 'ann')
+        self.assertIsInstance(token, bytes)
+        self.assertEqual(token[0], RECORD_KEY_VERSION)
+        self.assertFalse(enc.is_legacy(token))
+        self.assertNotEqual(token, enc.encrypt_password(
+            'hunter2', self.key, 'a.com', 'ann'))
+        self.assertEqual(enc.decrypt_password(token, self.key,
+                                              'a.com', 'ann'), 'hunter2')
+        rows = [('s%d.com' % i, 'u', 'p%d' % i) for i in range(10)]
+        tokens = enc.encrypt_passwords(rows, self.key)
+        self.assertEqual(enc.decrypt_passwords(
+            [(site, username, token) for (site, username, _), token
+             in zip(rows, tokens)], self.key), [x[2] for x in rows])
+
+    def test_legacy_decrypt(self) -> None:
+        token = fernet.Fernet(self.key).encrypt(b'hunter2')
+        for legacy in (token, token.decode()):
+            self.assertTrue(enc.is_legacy(legacy))
+            self.assertEqual(enc.decrypt_password(legacy, self.key,
+                                                  'a.com', 'ann'), 'hunter2')
+
+    def test_associated_data_mismatch(self) -> None:
+        token = enc.encrypt_password('hunter2', self.key, 'ann', 'a.com')
+        for site, username in (('a.com', 'ann'), ('ann', 'b.com'),
+                               ('an', 'na.com')):
+            with self.assertRaises(fernet.InvalidToken):
+                enc.decrypt_password(token, self.key, site, username)
+
+    def test_wrong_key(self) -> None:
+        token = enc.encrypt_password('hunter2', self.key, 'a.com', 'ann')
+        with self.assertRaises(fernet.InvalidToken):
+            enc.decrypt_password(token, fernet.Fernet.generate_key(),
+                                 'a.com', 'ann')
+
+
+class UpgradeTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.key = fernet.Fernet.generate_key()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def vaults(self) -> list:
+        log = logstore.LogDatabase()
+        log.path = os.path.join(self.directory.name, LOG_VAULT_FILE)
+        return [database.Database(os.path.join(self.directory.name,
+                                               DATABASE_FILE)), log]
+
+    def fill(self, vault: object) -> None:
+        vault.create_database()
+        legacy = fernet.Fernet(self.key)
+        vault.insert_many([('s%d.com' % i, 'u',
+                            legacy.encrypt(b'p%d' % i).decode())
+                           for i in range(5)])
+        vault.insert_data('new.com', 'u', enc.encrypt_password(
+            'fresh', self.key, 'new.com', 'u'))
+
+    def test_upgrade_records(self) -> None:
+        for vault in self.vaults():
+            with self.subTest(vault=type(vault).__name__):
+                self.fill(vault)
+                self.assertEqual(len(vault.query_legacy_records(10)), 5)
+                self.assertEqual(rekey.upgrade_records(vault, self.key), 5)
+                self.assertEqual(vault.query_legacy_records(10), [])
+                self.assertEqual(
+                    {x.site: enc.decrypt_password(x.password, self.key,
+                                                  x.site, x.username)
+                     for x in vault.query_database()},
+                    dict({'s%d.com' % i: 'p%d' % i for i in range(5)},
+                         **{'new.com': 'fresh'}))
+                vault.close()
+
+    def test_upgrade_with_wrong_key(self) -> None:
+        for vault in self.vaults():
+            with self.subTest(vault=type(vault).__name__):
+                self.fill(vault)
+                self.assertEqual(rekey.upgrade_records(
+                    vault, fernet.Fernet.generate_key()), 0)
+                self.assertEqual(len(vault.query_legacy_records(10)), 5)
+                vault.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
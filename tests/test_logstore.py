@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+import logstore
+from constants import LOG_VAULT_FILE
+
+
+class LogStoreTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, LOG_VAULT_FILE)
+        self.vault = self.open()
+        self.vault.create_database()
+        self.vault.set_password(b'header')
+
+    def tearDown(self) -> None:
+        self.vault.close()
+        self.directory.cleanup()
+
+    def open(self) -> logstore.LogDatabase:
+        vault = logstore.LogDatabase()
+        vault.path = self.path
+        return vault
+
+    def contents(self, vault: logstore.LogDatabase) -> list:
+        return [(x.id, x.site, x.username, x.password)
+                for x in vault.query_database()]
+
+    def test_round_trip(self) -> None:
+        self.assertTrue(self.vault.insert_data('a.com', 'ann', b'one'))
+        self.assertFalse(self.vault.insert_data('a.com', 'ann', b'two'))
+        self.vault.insert_many([('b.com', 'bob', b'three'),
+                                ('a.com', 'amy', b'four')])
+        self.vault.update_item('b.com', 'bob', b'five')
+        self.vault.delete_row('a.com', 'ann')
+        self.assertEqual(self.contents(self.vault),
+                         [(2, 'b.com', 'bob', b'five'),
+                          (3, 'a.com', 'amy', b'four')])
+        self.assertEqual([x.username for x in self.vault.query_site('a.com')],
+                         ['amy'])
+        self.assertEqual(self.vault.fetch_password(3), b'four')
+        self.assertEqual(self.vault.retrieve_password(), b'header')
+
+    def test_reopen(self) -> None:
+        self.vault.insert_many([('site%d.com' % i, 'user', b'secret')
+                                for i in range(50)])
+        self.vault.rebuild_index()
+        self.vault.delete_row('site3.com', 'user')
+        self.vault.insert_data('new.com', 'user', b'fresh')
+        expected = self.contents(self.vault)
+        reopened = self.open()
+        try:
+            self.assertEqual(self.contents(reopened), expected)
+            self.assertEqual(reopened.query_site('site3.com'), [])
+            self.assertEqual(len(reopened.query_site('site7.com')), 1)
+            self.assertTrue(reopened.insert_data('other.com', 'u', b'x'))
+            self.assertEqual(reopened.count(), 51)
+        finally:
+            reopened.close()
+        self.assertEqual(self.vault.count(), 51)
+
+    def test_compaction(self) -> None:
+        self.vault.insert_many([('site%d.com' % i, 'user', b'secret')
+                                for i in range(20)])
+        for _ in range(5):
+            for i in range(20):
+                self.vault.update_item('site%d.com' % i, 'user', b'changed')
+        reader = self.open()
+        reader.count()
+        size = os.path.getsize(self.path)
+        expected = self.contents(self.vault)
+        self.vault.rebuild_index()
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEqual(self.contents(self.vault), expected)
+        self.assertEqual(self.vault.retrieve_password(), b'header')
+        try:
+            self.assertEqual(self.contents(reader), expected)
+        finally:
+            reader.close()
+
+    def test_torn_tail(self) -> None:
+        self.vault.insert_data('a.com', 'ann', b'one')
+        size = os.path.getsize(self.path)
+        self.vault.insert_data('b.com', 'bob', b'two')
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 3)
+        reopened = self.open()
+        try:
+            self.assertEqual(self.contents(reopened),
+                             [(1, 'a.com', 'ann', b'one')])
+            self.assertTrue(reopened.insert_data('c.com', 'cat', b'three'))
+            self.assertEqual(self.contents(reopened),
+                             [(1, 'a.com', 'ann', b'one'),
+                              (2, 'c.com', 'cat', b'three')])
+            self.assertGreater(os.path.getsize(self.path), size)
+        finally:
+            reopened.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
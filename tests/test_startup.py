@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from benchmarks.suite import STARTUP_BUDGETS, STARTUP_FORBIDDEN, \
+    STARTUP_MISSING, probe_startup, startup_agent
+from benchmarks.vault import MASTER_PASSWORD
+import database as db
+import encryption as enc
+import kdf
+from constants import DATABASE_FILE
+
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        database = db.Database(os.path.join(self.directory.name,
+                                            DATABASE_FILE))
+        database.create_database()
+        header, self.key = kdf.create(MASTER_PASSWORD)
+        database.set_password(header)
+        database.insert_data('example.com', 'alice', enc.encrypt_password(
+            'secret', self.key, 'example.com', 'alice'))
+        database.close()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def probe(self, args: list, kind: str) -> float:
+        # The best of a few runs keeps a busy machine from failing the test.
+        with startup_agent(self.directory.name, self.key) as env:
+            runs = [probe_startup(self.directory.name, env, args,
+                                  STARTUP_FORBIDDEN[kind])
+                    for _ in range(3)]
+        _, output, errors, loaded = runs[-1]
+        self.assertEqual(loaded, [])
+        self.outcome = output, errors
+        return min(run[0] for run in runs)
+
+    def test_missing_entry(self) -> None:
+        elapsed = self.probe(STARTUP_MISSING, 'miss')
+        self.assertIn('No entry found for startup.probe', self.outcome[1])
+        self.assertLessEqual(elapsed, STARTUP_BUDGETS['miss'])
+
+    def test_decrypted_entry(self) -> None:
+        elapsed = self.probe(['get', 'example.com', 'alice'], 'hit')
+        self.assertEqual(self.outcome, (['secret'], ''))
+        self.assertLessEqual(elapsed, STARTUP_BUDGETS['hit'])
+
+
+if __name__ == '__main__':
+    unittest.main()
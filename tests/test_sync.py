@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+import database
+import sync
+import encryption as enc
+from cryptography import fernet
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.key = fernet.Fernet.generate_key()
+        self.local = self.open('local.db')
+        self.remote = self.open('remote.db')
+        for site in ('a.com', 'b.com', 'c.com'):
+            self.add(self.local, site, 'first')
+        sync.merge(self.local, self.remote, self.key, self.key)
+        self.assertConverged()
+
+    def tearDown(self) -> None:
+        self.local.close()
+        self.remote.close()
+        self.directory.cleanup()
+
+    def open(self, name: str) -> database.Database:
+        vault = database.Database(os.path.join(self.directory.name, name))
+        vault.create_database()
+        vault.set_password(b'header')
+        return vault
+
+    def token(self, site: str, password: str) -> bytes:
+        return enc.encrypt_password(password, self.key, site, 'ann')
+
+    def add(self, vault: database.Database, site: str,
+            password: str) -> None:
+        self.assertTrue(vault.insert_data(site, 'ann',
+                                          self.token(site, password)))
+
+    def update(self, vault: database.Database, site: str,
+               password: str) -> None:
+        vault.update_item(site, 'ann', self.token(site, password))
+
+    def contents(self, vault: database.Database) -> dict:
+        return {x.site: enc.decrypt_password(x.password, self.key,
+                                             x.site, x.username)
+                for x in vault.query_database()}
+
+    def assertConverged(self) -> None:
+        self.assertEqual(self.contents(self.local),
+                         self.contents(self.remote))
+        self.assertEqual(sync.MerkleTree(self.local.sync_leaves()).root,
+                         sync.MerkleTree(self.remote.sync_leaves()).root)
+        report = sync.merge(self.local, self.remote, self.key, self.key)
+        self.assertEqual(report.buckets, 0)
+
+    def test_update_against_update(self) -> None:
+        self.update(self.local, 'a.com', 'local')
+        self.update(self.remote, 'a.com', 'remote')
+        self.update(self.remote, 'b.com', 'remote')
+        self.update(self.local, 'b.com', 'local')
+        report = sync.merge(self.local, self.remote, self.key, self.key)
+        self.assertEqual(report.conflicts, 2)
+        self.assertConverged()
+        self.assertEqual(self.contents(self.local),
+                         {'a.com': 'remote', 'b.com': 'local',
+                          'c.com': 'first'})
+
+    def test_delete_against_update(self) -> None:
+        self.local.delete_row('a.com', 'ann')
+        self.update(self.remote, 'a.com', 'remote')
+        self.update(self.local, 'b.com', 'local')
+        self.remote.delete_row('b.com', 'ann')
+        sync.merge(self.local, self.remote, self.key, self.key)
+        self.assertConverged()
+        self.assertEqual(self.contents(self.local),
+                         {'a.com': 'remote', 'c.com': 'first'})
+
+    def test_add_after_delete(self) -> None:
+        self.local.delete_row('a.com', 'ann')
+        sync.merge(self.local, self.remote, self.key, self.key)
+        self.assertConverged()
+        self.assertNotIn('a.com', self.contents(self.remote))
+        self.add(self.remote, 'a.com', 'again')
+        report = sync.merge(self.local, self.remote, self.key, self.key)
+        self.assertEqual(len(report.pulled), 1)
+        self.assertConverged()
+        self.assertEqual(self.contents(self.local)['a.com'], 'again')
+
+    def test_dry_run(self) -> None:
+        self.update(self.local, 'c.com', 'local')
+        report = sync.merge(self.local, self.remote, self.key, self.key,
+                            dry_run=True)
+        self.assertEqual(len(report.pushed), 1)
+        self.assertEqual(self.contents(self.remote)['c.com'], 'first')
+
+
+if __name__ == '__main__':
+    unittest.main()